@@ -0,0 +1,734 @@
+#!/usr/bin/env python3
+#
+#    LEGO Mindstorms Editions Pieces Comparison
+#    Copyright (C) 2015-2018  Peter Bittner <django@bittner.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmarks for lego-mindstorms-pieces.py on synthetic inventory data.
+"""
+import filecmp
+import glob
+import hashlib
+import importlib.util
+import itertools
+import json
+import os.path
+import random
+import subprocess
+import sys
+import resource
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+
+import inventory
+
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+PIECES_SCRIPT = os.path.join(SCRIPT_PATH, 'lego-mindstorms-pieces.py')
+RAW_DATA = os.path.join(SCRIPT_PATH, 'raw-data')
+BASELINE = os.path.join(SCRIPT_PATH, 'benchmark-baseline.json')
+
+# functions measured by the suite, and the data file each of them reads
+SUITE_TARGETS = ['parse', 'missing', 'UpdatedPartMapping', 'MindstormsElectricPart']
+SUITE_METRICS = ['wall_s', 'peak_rss_mb', 'alloc_peak_mb', 'alloc_blocks']
+
+# a result regresses when it exceeds the baseline by this ratio plus slack
+DEFAULT_THRESHOLDS = {
+    'wall_s': {'ratio': 0.5, 'slack': 0.05},
+    'peak_rss_mb': {'ratio': 0.2, 'slack': 5},
+    'alloc_peak_mb': {'ratio': 0.2, 'slack': 1},
+    'alloc_blocks': {'ratio': 0.2, 'slack': 1000},
+}
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark lego-mindstorms-pieces.py on synthetic data.")
+    commands = parser.add_subparsers(metavar='command', dest='command')
+    commands.required = True
+
+    cmd = commands.add_parser(
+        'parse', help="Measure wall time and peak RSS of the parse command for a growing"
+                      " number of synthetic Brickset inventory files.")
+    cmd.add_argument('--sets', '-n', type=int, nargs='+', default=[100, 200, 400, 800],
+                     help="Numbers of LEGO sets to merge. Default: 100 200 400 800")
+    cmd.add_argument('--parts', type=int, default=5000,
+                     help="Number of distinct parts to draw from. Default: 5000")
+    cmd.add_argument('--rows', type=int, default=500,
+                     help="Number of rows in each inventory file. Default: 500")
+    cmd.add_argument('--seed', type=int, default=31313,
+                     help="Seed for the random data generator. Default: 31313")
+
+    cmd = commands.add_parser(
+        'jobs', help="Measure the speed-up of parse --jobs N per number of worker processes"
+                     " on a directory of synthetic Brickset inventory files.")
+    cmd.add_argument('--jobs', '-j', type=int, nargs='+',
+                     default=sorted({1, 2, 4, os.cpu_count() or 1}),
+                     help="Numbers of worker processes to compare. Default: 1 2 4 <CPUs>")
+    cmd.add_argument('--sets', '-n', type=int, default=2000,
+                     help="Number of LEGO sets to merge. Default: 2000")
+    cmd.add_argument('--parts', type=int, default=5000,
+                     help="Number of distinct parts to draw from. Default: 5000")
+    cmd.add_argument('--rows', type=int, default=500,
+                     help="Number of rows in each inventory file. Default: 500")
+    cmd.add_argument('--seed', type=int, default=31313,
+                     help="Seed for the random data generator. Default: 31313")
+
+    cmd = commands.add_parser(
+        'incremental', help="Compare the wall time of parse --incremental with nothing or one"
+                            " file changed with that of a full parse of synthetic Brickset"
+                            " inventory files.")
+    cmd.add_argument('--sets', '-n', type=int, default=400,
+                     help="Number of LEGO sets to merge. Default: 400")
+    cmd.add_argument('--parts', type=int, default=5000,
+                     help="Number of distinct parts to draw from. Default: 5000")
+    cmd.add_argument('--rows', type=int, default=500,
+                     help="Number of rows in each inventory file. Default: 500")
+    cmd.add_argument('--seed', type=int, default=31313,
+                     help="Seed for the random data generator. Default: 31313")
+
+    cmd = commands.add_parser(
+        'dump', help="Measure the throughput (MB/s) of parse --sets, extracting a few sets"
+                     " from a synthetic full Brickset inventory dump.")
+    cmd.add_argument('--sets', '-n', type=int, default=20000,
+                     help="Number of LEGO sets in the dump. Default: 20000")
+    cmd.add_argument('--extract', type=int, nargs='+', default=[1, 10, 100],
+                     help="Numbers of sets to extract from the dump. Default: 1 10 100")
+    cmd.add_argument('--parts', type=int, default=5000,
+                     help="Number of distinct parts to draw from. Default: 5000")
+    cmd.add_argument('--rows', type=int, default=100,
+                     help="Number of rows of each set in the dump. Default: 100")
+    cmd.add_argument('--seed', type=int, default=31313,
+                     help="Seed for the random data generator. Default: 31313")
+
+    cmd = commands.add_parser(
+        'missing', help="Measure loading a synthetic combined list into an inventory"
+                        " matrix and answering owned-vs-wanted queries on it.")
+    cmd.add_argument('--sets', '-n', type=int, default=400,
+                     help="Number of LEGO sets in the combined list. Default: 400")
+    cmd.add_argument('--parts', type=int, default=5000,
+                     help="Number of distinct parts to draw from. Default: 5000")
+    cmd.add_argument('--rows', type=int, default=500,
+                     help="Number of rows in each inventory file. Default: 500")
+    cmd.add_argument('--queries', type=int, default=100,
+                     help="Number of random queries to answer. Default: 100")
+    cmd.add_argument('--seed', type=int, default=31313,
+                     help="Seed for the random data generator. Default: 31313")
+
+    cmd = commands.add_parser(
+        'order', help="Run the full order flow against a local fake shop (fakeshop.py)"
+                      " and report parts per minute. Needs Selenium and a browser driver.")
+    cmd.add_argument('--browser', '-b', default='firefox', choices=['chrome', 'firefox'],
+                     help="Web browser to use. Default: firefox")
+    cmd.add_argument('--show-browser', dest='headless', action='store_false',
+                     help="Show the browser window instead of running headless")
+    cmd.add_argument('--lego-set', '-l', default='45544',
+                     help="LEGO set to order all parts of. Default: 45544")
+    cmd.add_argument('--parts', type=int,
+                     help="Only order the first N parts of the set")
+    cmd.add_argument('--latency', type=float, nargs='+', default=[0, .2],
+                     help="Fake shop latencies (seconds) to compare. Default: 0 0.2")
+    cmd.add_argument('--no-element-list', dest='element_list', action='store_false',
+                     help="Fake shop only shows elements when they're searched for")
+    cmd.add_argument('--out-of-stock', type=float, default=.05,
+                     help="Fraction of elements out of stock. Default: 0.05")
+    cmd.add_argument('--workers', '-w', type=int, default=0,
+                     help="Number of headless lookup browsers. Default: 0")
+    cmd.add_argument('--batch-size', type=int, nargs='+', default=[1, 25],
+                     help="Numbers of found parts added to the bag at once to compare."
+                          " Default: 1 25")
+
+    cmd = commands.add_parser(
+        'sessions', help="Order parts of several sets of one shop in the same browser session"
+                         " against a local fake shop, checking it logs in once and reads each set's"
+                         " own element list. Needs Selenium and a browser driver.")
+    cmd.add_argument('--browser', '-b', default='firefox', choices=['chrome', 'firefox'],
+                     help="Web browser to use. Default: firefox")
+    cmd.add_argument('--show-browser', dest='headless', action='store_false',
+                     help="Show the browser window instead of running headless")
+    cmd.add_argument('--lego-sets', '-l', nargs='+', default=['45544', '31313', '45544'],
+                     help="LEGO sets to order parts of, one after the other."
+                          " Default: 45544 31313 45544")
+    cmd.add_argument('--parts', type=int, default=10,
+                     help="Number of parts to order of each set. Default: 10")
+
+    cmd = commands.add_parser(
+        'suite', help="Measure wall time, peak RSS and allocations of parse, missing and the"
+                      " data loaders of legoshop.py on synthetic data of growing size, and"
+                      " compare them with a JSON baseline.")
+    cmd.add_argument('--sizes', type=int, nargs='+', default=[10**2, 10**4, 10**6],
+                     help="Numbers of data file rows to measure with. Default: 100 10000"
+                          " 1000000")
+    cmd.add_argument('--targets', nargs='+', default=SUITE_TARGETS, choices=SUITE_TARGETS,
+                     help="Functions to measure. Default: all")
+    cmd.add_argument('--baseline', default=BASELINE,
+                     help="JSON baseline to compare with. Default: {}".format(BASELINE))
+    cmd.add_argument('--save', action='store_true',
+                     help="Write the results as the new --baseline instead of comparing")
+    cmd.add_argument('--seed', type=int, default=31313,
+                     help="Seed for the random data generator. Default: 31313")
+
+    # run by the suite in a child process per measurement
+    cmd = commands.add_parser('measure')
+    cmd.add_argument('target', choices=SUITE_TARGETS)
+    cmd.add_argument('mode', choices=['time', 'alloc'])
+    cmd.add_argument('datafiles', nargs='+')
+
+    # avoid intimidating the user ("error: ... required") with no arguments
+    if len(sys.argv) == 1:
+        parser.print_help()
+        parser.exit()
+
+    args = parser.parse_args()
+    kwargs = vars(args).copy()
+    kwargs.pop('command', None)
+
+    function = globals()['bench_' + args.command]
+    function(**kwargs)
+
+
+def make_part_pool(parts, rng):
+    """
+    Generate a sorted list of distinct, realistic looking part numbers.
+    """
+    return sorted(rng.sample(range(300000, 6300000), parts))
+
+
+def write_brickset_inventory(filename, set_no, part_pool, rows, rng):
+    """
+    Write a synthetic Brickset inventory export for a single LEGO set.
+    """
+    with open(filename, 'w') as f:
+        f.write('SetNumber\tPartID\tQuantity\tColour\tCategory\tDesignID'
+                '\tPartName\tImageURL\tSetCount\n')
+        for part_no in rng.sample(part_pool, rows):
+            f.write('%s-1\t%s\t%s\tBlack\tSystem: Bricks\t%s\tPart %s'
+                    '\thttp://cache.lego.com/media/bricks/5/1/%s.jpg\t%s\n' % (
+                        set_no, part_no, rng.randint(1, 40), part_no // 100,
+                        part_no, part_no, rng.randint(1, 400)))
+
+
+def write_brickset_dump(filename, sets, part_pool, rows, rng):
+    """
+    Write a synthetic full Brickset inventory dump of many LEGO sets.
+    """
+    with open(filename, 'w') as f:
+        f.write('SetNumber\tPartID\tQuantity\tColour\tCategory\tDesignID'
+                '\tPartName\tImageURL\tSetCount\n')
+        for set_no in range(10000, 10000 + sets):
+            for part_no in rng.sample(part_pool, rows):
+                f.write('%s-1\t%s\t%s\tBlack\tSystem: Bricks\t%s\tPart %s'
+                        '\thttp://cache.lego.com/media/bricks/5/1/%s.jpg\t%s\n' % (
+                            set_no, part_no, rng.randint(1, 40), part_no // 100,
+                            part_no, part_no, rng.randint(1, 400)))
+
+
+def write_brickset_inventories(directory, sets, part_pool, rows, rng):
+    """
+    Write synthetic Brickset inventory exports and return their file names.
+    """
+    filenames = []
+    for set_no in range(10000, 10000 + sets):
+        filename = os.path.join(directory, 'Brickset-inventory-%s-1.csv' % set_no)
+        write_brickset_inventory(filename, set_no, part_pool, rows, rng)
+        filenames.append(filename)
+    return filenames
+
+
+def run_measured(command):
+    """
+    Run a command in a child process, return its wall time and peak RSS (in KiB).
+    """
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    pid, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode:
+        raise SystemExit("Command failed with exit code %s: %s" % (
+            process.returncode, ' '.join(command[:4])))
+
+    return elapsed, rusage.ru_maxrss
+
+
+def bench_parse(sets, parts, rows, seed):
+    """
+    Show that the peak memory of parse stays flat while the input grows.
+    """
+    rng = random.Random(seed)
+    part_pool = make_part_pool(parts, rng)
+    rows = min(rows, parts)
+
+    print('%6s  %10s  %10s  %8s  %12s' % ('sets', 'rows', 'input MB', 'wall s', 'peak RSS MB'))
+
+    for set_count in sets:
+        with tempfile.TemporaryDirectory() as directory:
+            filenames = write_brickset_inventories(directory, set_count, part_pool, rows, rng)
+            input_size = sum(os.path.getsize(name) for name in filenames)
+
+            elapsed, max_rss = run_measured(
+                [sys.executable, PIECES_SCRIPT, 'parse', '--output', os.devnull] + filenames)
+
+        print('%6d  %10d  %10.1f  %8.2f  %12.1f' % (
+            set_count, set_count * rows, input_size / 2**20, elapsed, max_rss / 2**10))
+
+
+def bench_jobs(jobs, sets, parts, rows, seed):
+    """
+    Compare wall times of parse with a growing number of worker processes.
+    """
+    rng = random.Random(seed)
+    part_pool = make_part_pool(parts, rng)
+    rows = min(rows, parts)
+
+    print('%d CPUs, %d sets x %d rows' % (os.cpu_count() or 1, sets, rows))
+    print('%6s  %8s  %8s  %s' % ('jobs', 'wall s', 'speed-up', 'output SHA-1'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_brickset_inventories(directory, sets, part_pool, rows, rng)
+        output = os.path.join(directory, 'combined list.csv')
+        baseline = None
+
+        for job_count in jobs:
+            elapsed, max_rss = run_measured(
+                [sys.executable, PIECES_SCRIPT, 'parse', '--jobs', str(job_count),
+                 '--output', output, directory])
+            with open(output, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+
+            baseline = baseline or elapsed
+            print('%6d  %8.2f  %7.2fx  %s' % (job_count, elapsed, baseline / elapsed, digest))
+
+
+def bench_incremental(sets, parts, rows, seed):
+    """
+    Show that an incremental parse with few changes is faster than a full
+    one, and writes the same combined list.
+    """
+    rng = random.Random(seed)
+    part_pool = make_part_pool(parts, rng)
+    rows = min(rows, parts)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = write_brickset_inventories(directory, sets, part_pool, rows, rng)
+        full = os.path.join(directory, 'full.csv')
+        output = os.path.join(directory, 'incremental.csv')
+        print('%d sets x %d rows, %.1f MB' % (
+            sets, rows, sum(os.path.getsize(name) for name in filenames) / 2**20))
+        print('%-24s  %8s  %s' % ('run', 'wall s', 'same as full parse'))
+
+        def run(name, incremental):
+            command = [sys.executable, PIECES_SCRIPT, 'parse', '--output']
+            command += [output, '--incremental'] if incremental else [full]
+            elapsed, max_rss = run_measured(command + filenames)
+            same = '-'
+            if incremental:
+                run_measured([sys.executable, PIECES_SCRIPT, 'parse', '--output', full]
+                             + filenames)
+                same = 'yes' if filecmp.cmp(full, output, shallow=False) else 'NO'
+            print('%-24s  %8.2f  %s' % (name, elapsed, same))
+
+        run('full parse', False)
+        run('incremental, first run', True)
+        run('incremental, no change', True)
+        write_brickset_inventory(filenames[len(filenames) // 2], 10000 + len(filenames) // 2,
+                                 part_pool, rows, rng)
+        run('incremental, 1 changed', True)
+
+        print('Build state: %.1f KB' % (os.path.getsize(output + '.state.json') / 2**10))
+
+
+def bench_dump(sets, extract, parts, rows, seed):
+    """
+    Show the throughput of extracting sets from a full inventory dump.
+    """
+    rng = random.Random(seed)
+    part_pool = make_part_pool(parts, rng)
+    rows = min(rows, parts)
+
+    with tempfile.TemporaryDirectory() as directory:
+        dumpfile = os.path.join(directory, 'Brickset-inventories.csv')
+        write_brickset_dump(dumpfile, sets, part_pool, rows, rng)
+        dump_size = os.path.getsize(dumpfile)
+
+        print('%d sets x %d rows, %.1f MB' % (sets, rows, dump_size / 2**20))
+        print('%8s  %8s  %8s  %12s' % ('extract', 'wall s', 'MB/s', 'peak RSS MB'))
+
+        for set_count in extract:
+            chosen = rng.sample(range(10000, 10000 + sets), min(set_count, sets))
+            elapsed, max_rss = run_measured(
+                [sys.executable, PIECES_SCRIPT, 'parse', '--output', os.devnull,
+                 '--sets', ','.join(map(str, chosen)), dumpfile])
+
+            print('%8d  %8.2f  %8.1f  %12.1f' % (
+                set_count, elapsed, dump_size / 2**20 / elapsed, max_rss / 2**10))
+
+
+def write_combined_list(filename, sets, part_pool, rng):
+    """
+    Write a synthetic combined list of the given parts, in about half of
+    the sets each.
+    """
+    with open(filename, 'w') as f:
+        f.write('Part no.\tLego ID\t%s\tPart name\tImage\n' % '\t'.join(
+            'Brickset-inventory-%s-1.csv' % set_no for set_no in range(10000, 10000 + sets)))
+        for part_no in part_pool:
+            f.write('%s\t%s\t%s\tPart %s\thttp://cache.lego.com/media/bricks/5/1/%s.jpg\n' % (
+                part_no, part_no // 100,
+                '\t'.join(str(max(0, rng.randint(-4, 4))) for set_no in range(sets)),
+                part_no, part_no))
+
+
+def write_elementid_refresh(filename, part_pool, rng):
+    """
+    Write a synthetic list of new element IDs for the given parts, every
+    tenth of them replaced by the next one in turn (chains of two).
+    """
+    with open(filename, 'w') as f:
+        f.write('Orig ElementID;New ElementIDs (comma separated);Comment\n')
+        for index, part_no in enumerate(part_pool):
+            if index % 10 == 0 and index + 1 < len(part_pool):
+                new_part_nos = [part_pool[index + 1]]
+            else:
+                new_part_nos = [rng.randint(6300000, 9999999) for _ in range(rng.randint(1, 2))]
+            f.write('%s;%s;https://www.brickowl.com/catalog/lego-part-%s\n' % (
+                part_no, ','.join(map(str, new_part_nos)), part_no))
+
+
+def write_electric_parts(filename, part_pool, rng):
+    """
+    Write a synthetic list of electric parts and their standalone sets.
+    """
+    with open(filename, 'w') as f:
+        f.write('Part no.\tDesignID\tStandalone Set\n')
+        for part_no in part_pool:
+            f.write('%s\t%s\t%s\n' % (part_no, part_no // 100, rng.randint(45500, 45599)))
+
+
+def write_suite_data(directory, target, size, rng):
+    """
+    Write the synthetic data files of ``size`` rows a suite target reads,
+    return their file names.
+    """
+    if target == 'parse':
+        rows = min(size, 500)
+        part_pool = make_part_pool(max(rows, min(size // 10, 5000)), rng)
+        return write_brickset_inventories(directory, max(1, size // rows), part_pool, rows, rng)
+
+    filename = os.path.join(directory, target + '.csv')
+    part_pool = make_part_pool(size, rng)
+    if target == 'missing':
+        write_combined_list(filename, 10, part_pool, rng)
+    elif target == 'UpdatedPartMapping':
+        write_elementid_refresh(filename, part_pool, rng)
+    else:
+        write_electric_parts(filename, part_pool, rng)
+    return [filename]
+
+
+def peak_rss():
+    """
+    Peak RSS (in KiB) of this process.  Linux keeps ``ru_maxrss`` across
+    fork and exec, so the high water mark of the process image is read
+    from ``/proc`` where available.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_measure(target, mode, datafiles):
+    """
+    Run a suite target once (in a child process of the suite), print its
+    wall time and peak RSS, or its allocations, as JSON.
+    """
+    import legoshop
+
+    spec = importlib.util.spec_from_file_location('lego_mindstorms_pieces', PIECES_SCRIPT)
+    pieces = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pieces)
+
+    if target == 'parse':
+        def run():
+            pieces.parse(datafiles, output=os.devnull)
+    elif target == 'missing':
+        sets = [str(set_no) for set_no in range(10000, 10006)]
+
+        def run():
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                pieces.missing(None, datafiles[0], own=sets[:3], want=sets[3:])
+    else:
+        def run():
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                getattr(legoshop, target)(datafiles[0])
+
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+    try:
+        if mode == 'time':
+            start = time.perf_counter()
+            run()
+            elapsed = time.perf_counter() - start
+            result = {'wall_s': elapsed, 'peak_rss_mb': peak_rss() / 2**10}
+        else:
+            blocks = sys.getallocatedblocks()
+            tracemalloc.start()
+            run()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result = {'alloc_peak_mb': peak / 2**20,
+                      'alloc_blocks': sys.getallocatedblocks() - blocks}
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+    print(json.dumps(result))
+
+
+def run_suite_target(target, datafiles):
+    """
+    Measure a suite target in fresh child processes, each starting without
+    compiled indexes, return its metrics
+    """
+    result = {}
+    for mode in ('time', 'alloc'):
+        for name in datafiles:
+            for index_file in glob.glob(glob.escape(name) + '.*'):
+                os.remove(index_file)
+
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), 'measure', target, mode] + datafiles)
+        result.update(json.loads(output.decode().splitlines()[-1]))
+    return result
+
+
+def regressions(results, baseline):
+    """
+    Compare results with a baseline, return a message per metric that
+    exceeds it by more than its threshold
+    """
+    thresholds = baseline.get('thresholds', DEFAULT_THRESHOLDS)
+    messages = []
+    for target, sizes in sorted(results.items()):
+        for size, metrics in sorted(sizes.items(), key=lambda item: int(item[0])):
+            reference = baseline.get('results', {}).get(target, {}).get(size)
+            if reference is None:
+                continue
+            for metric, value in metrics.items():
+                threshold = thresholds.get(metric)
+                if threshold is None or metric not in reference:
+                    continue
+                limit = reference[metric] * (1 + threshold['ratio']) + threshold['slack']
+                if value > limit:
+                    messages.append('%s %s rows: %s %.3f > %.3f (baseline %.3f)' % (
+                        target, size, metric, value, limit, reference[metric]))
+    return messages
+
+
+def bench_suite(sizes, targets, baseline, save, seed):
+    """
+    Measure the data file readers at growing sizes, compare with or save
+    a baseline.
+    """
+    rng = random.Random(seed)
+    results = {}
+
+    print('%-24s  %8s  %8s  %12s  %14s  %12s' % (
+        'target', 'rows', 'wall s', 'peak RSS MB', 'alloc peak MB', 'alloc blocks'))
+
+    for target in targets:
+        for size in sizes:
+            with tempfile.TemporaryDirectory() as directory:
+                datafiles = write_suite_data(directory, target, size, rng)
+                metrics = run_suite_target(target, datafiles)
+
+            results.setdefault(target, {})[str(size)] = {
+                metric: round(value, 4) for metric, value in metrics.items()}
+            print('%-24s  %8d  %8.3f  %12.1f  %14.1f  %12d' % (
+                target, size, metrics['wall_s'], metrics['peak_rss_mb'],
+                metrics['alloc_peak_mb'], metrics['alloc_blocks']))
+
+    if save:
+        try:
+            with open(baseline) as f:
+                thresholds = json.load(f).get('thresholds', DEFAULT_THRESHOLDS)
+        except (OSError, ValueError):
+            thresholds = DEFAULT_THRESHOLDS
+
+        with open(baseline, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'thresholds': thresholds,
+                       'results': results}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved baseline: %s' % baseline)
+        return
+
+    try:
+        with open(baseline) as f:
+            reference = json.load(f)
+    except (OSError, ValueError) as err:
+        raise SystemExit("Cannot read baseline {}: {}".format(baseline, err))
+
+    messages = regressions(results, reference)
+    if messages:
+        raise SystemExit('Regressions against {}:\n{}'.format(baseline, '\n'.join(messages)))
+    print('No regressions against %s' % baseline)
+
+
+def bench_missing(sets, parts, rows, queries, seed):
+    """
+    Time loading the inventory matrix once and querying it many times.
+    """
+    rng = random.Random(seed)
+    part_pool = make_part_pool(parts, rng)
+    rows = min(rows, parts)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filenames = write_brickset_inventories(directory, sets, part_pool, rows, rng)
+        combined_list = os.path.join(directory, 'combined list.csv')
+        with open(combined_list, 'w') as f, open(os.devnull, 'w') as stderr:
+            sys.stderr, stderr = stderr, sys.stderr
+            try:
+                inventory.merge(filenames, f)
+            finally:
+                sys.stderr = stderr
+
+        load_times = []
+        for loader in (inventory.InventoryMatrix.from_combined_list,  # parse text
+                       inventory.InventoryMatrix.load,  # build compiled index
+                       inventory.InventoryMatrix.load):  # memory-map index
+            start = time.perf_counter()
+            matrix = loader(combined_list)
+            load_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for query in range(queries):
+        chosen = rng.sample(matrix.sets, rng.randint(2, 20))
+        split = len(chosen) // 2
+        matrix.missing(chosen[:split], chosen[split:])
+    query_time = (time.perf_counter() - start) / queries
+
+    print('%d parts x %d sets' % (len(matrix.part_numbers), len(matrix.sets)))
+    print('load:  %8.1f ms (text), %.1f ms (building index), %.1f ms (memory-mapped index)'
+          % tuple(load_time * 1000 for load_time in load_times))
+    print('query: %8.2f ms (average of %d, 2-20 sets each)' % (query_time * 1000, queries))
+
+
+def bench_order(browser, headless, lego_set, parts, latency, element_list, out_of_stock,
+                workers, batch_size):
+    """
+    Measure the order flow end to end against a local fake shop.
+    """
+    import fakeshop
+    import legoshop
+
+    matrix = inventory.InventoryMatrix.load(
+        os.path.join(RAW_DATA, 'Lego Mindstorms EV3 combined list.csv'))
+    wanted = matrix.missing([], [lego_set])[:parts]
+    order_list = ','.join('{pn}:{qty}'.format(pn=part_no, qty=min(quantity, 200))
+                          for part_no, quantity in wanted)
+
+    catalogs = fakeshop.default_catalogs()
+    fakeshop.mark_out_of_stock(catalogs, out_of_stock)
+
+    print('%8s  %5s  %6s  %9s  %8s  %9s  %6s  %10s  %6s  %8s' % (
+        'latency', 'batch', 'parts', 'startup s', 'wall s', 'parts/min', 'found',
+        'not in set', 'stock', 'electric'))
+
+    for shop_latency, batch in itertools.product(latency, batch_size):
+        shop = fakeshop.FakeShop(catalogs, shop_latency, element_list=element_list)
+        order = legoshop.ReplacementPart(browser, 'en-us', headless)
+        order.base_url = shop.start()
+        order.set_new_element_id_datafile(os.path.join(RAW_DATA, 'elementid-refresh.csv'))
+        order.set_electric_part_datafile(os.path.join(RAW_DATA, 'Electric-parts.csv'))
+        order.set_credentials('benchmark', 'benchmark')
+        order.set_lookup_workers(workers)
+        order.set_batch_size(batch)
+
+        try:
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                start = time.perf_counter()
+                order.process(lego_set, order_list)
+                elapsed = time.perf_counter() - start
+        finally:
+            order.close()
+            shop.stop()
+
+        stats = order.part_stats_counter
+        print('%8.2f  %5d  %6d  %9.1f  %8.1f  %9.1f  %6d  %10d  %6d  %8d' % (
+            shop_latency, batch, stats['total_elements'],
+            sum(map(sum, order.tracer.durations('startup').values())), elapsed,
+            stats['total_elements'] * 60 / elapsed, stats['found'], stats['not_in_set'],
+            stats['out_of_stock'], stats['electric_part']))
+
+
+def bench_sessions(browser, headless, lego_sets, parts):
+    """
+    Run orders of several sets of the same shop in one browser session
+    against a local fake shop, logging in once, and check that each set
+    was selected and its own element list read.
+    """
+    import fakeshop
+    import legoshop
+
+    matrix = inventory.InventoryMatrix.load(
+        os.path.join(RAW_DATA, 'Lego Mindstorms EV3 combined list.csv'))
+    shop = fakeshop.FakeShop(fakeshop.default_catalogs())
+    order = legoshop.ReplacementPart(browser, 'en-us', headless)
+    order.base_url = shop.start()
+    order.set_new_element_id_datafile(os.path.join(RAW_DATA, 'elementid-refresh.csv'))
+    order.set_electric_part_datafile(os.path.join(RAW_DATA, 'Electric-parts.csv'))
+    order.set_credentials('benchmark', 'benchmark')
+
+    print('%8s  %6s  %8s  %6s  %s' % ('set', 'parts', 'wall s', 'found', 'startup steps'))
+
+    logins = 0
+    try:
+        for lego_set in lego_sets:
+            order_list = ','.join('{pn}:{qty}'.format(pn=part_no, qty=min(quantity, 200))
+                                  for part_no, quantity in matrix.missing([], [lego_set])[:parts])
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                start = time.perf_counter()
+                order.process(lego_set, order_list)
+                elapsed = time.perf_counter() - start
+
+            if shop.selected_sets[-1:] != [lego_set]:
+                raise SystemExit('Selected set %s instead of %s' % (
+                    ', '.join(shop.selected_sets[-1:]) or 'none', lego_set))
+            if not order.catalog or not set(order.catalog) <= set(shop.catalogs[lego_set]):
+                raise SystemExit('The element list read for set %s is not its own' % lego_set)
+
+            steps = list(order.tracer.durations('startup'))
+            logins += 'login' in steps
+            print('%8s  %6d  %8.1f  %6d  %s' % (
+                lego_set, order.part_stats_counter['total_elements'], elapsed,
+                order.part_stats_counter['found'], ', '.join(steps) or '-'))
+    finally:
+        order.close()
+        shop.stop()
+
+    if logins != 1:
+        raise SystemExit('Logged in %d times, expected once' % logins)
+
+
+if __name__ == "__main__":
+    main()
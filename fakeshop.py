@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+#
+#    LEGO Mindstorms Editions Pieces Comparison
+#    Copyright (C) 2015-2018  Peter Bittner <django@bittner.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+A local stand-in for LEGO's replacement parts shop.  It serves the page
+elements legoshop.py works with (cookie button, age field, LEGO ID login
+frame, set number field, element filter, element list and shopping bag),
+with configurable catalogs and latency, to measure and test the order
+command offline.
+
+Run ``python3 fakeshop.py`` and point ``order --base-url`` at the URL shown.
+"""
+import json
+import os.path
+import random
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import inventory
+
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+RAW_DATA = os.path.join(SCRIPT_PATH, 'raw-data')
+
+SALE_PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Replacement parts (fake shop)</title>
+<style>
+.hidden { display: none; }
+#login-frame iframe { width: 400px; height: 200px; }
+</style>
+</head>
+<body>
+<div class="legoid-box"><div class="links" id="legoid-links"></div></div>
+
+<div id="cookie-banner">
+  We use cookies. <button class="l-accept__btn" onclick="acceptCookies()">Accept</button>
+</div>
+
+<div id="age-form">
+  How old are you? <input type="text" name="rpAgeAndCountryAgeField">
+</div>
+
+<div id="login-frame" class="hidden">
+  <iframe id="legoid-iframe" name="legoid-iframe"></iframe>
+</div>
+
+<div class="product-search hidden">
+  Set number: <input type="text" ng-model="productNumber">
+</div>
+
+<div id="elements" class="hidden">
+  Element ID: <input type="text" id="element-filter">
+  <ul id="element-list"></ul>
+</div>
+
+<div id="bag"></div>
+
+<script>
+var config = %(config)s;
+var setElements = [];
+
+function hasCookie(name) {
+    return document.cookie.split('; ').indexOf(name + '=1') >= 0;
+}
+
+function setCookie(name) {
+    document.cookie = name + '=1; path=/';
+}
+
+function later(callback) {
+    setTimeout(callback, config.latency);
+}
+
+function showLinks() {
+    var links = document.getElementById('legoid-links');
+    if (hasCookie('fakeshop_session')) {
+        links.innerHTML = '<a href="#" data-uitest="logout-link">Log out</a>';
+    } else {
+        links.innerHTML = '<a href="#" data-uitest="login-link" onclick="showLogin()">Log in</a>';
+    }
+}
+
+function showLogin() {
+    document.getElementById('login-frame').className = '';
+    document.getElementById('legoid-iframe').src = '/legoid/login';
+    return false;
+}
+
+function loggedIn() {
+    setCookie('fakeshop_session');
+    document.getElementById('login-frame').className = 'hidden';
+    showLinks();
+}
+
+function acceptCookies() {
+    setCookie('fakeshop_cookies');
+    document.getElementById('cookie-banner').className = 'hidden';
+}
+
+function passAgeGate() {
+    var form = document.getElementById('age-form');
+    form.parentNode.removeChild(form);
+    document.querySelector('.product-search').className = 'product-search';
+}
+
+function renderElements(elements) {
+    var html = '';
+    elements.forEach(function (element) {
+        html += '<li><div class="element-details">Element ID: ' + element[0] +
+            ' (' + element[2] + ')</div><button' + (element[1] ? '' : ' disabled') +
+            ' onclick="addToBag(' + element[0] + ')">Add</button>' +
+            '<span class="element-price">' + element[3] + '</span></li>';
+    });
+    document.getElementById('element-list').innerHTML = html;
+}
+
+function selectSet(setNumber) {
+    var request = new XMLHttpRequest();
+    request.onload = function () {
+        later(function () {
+            setElements = request.status === 200 ? JSON.parse(request.responseText) : [];
+            renderElements(config.elementList ? setElements : []);
+            document.getElementById('elements').className = '';
+        });
+    };
+    request.open('GET', '/api/sets/' + encodeURIComponent(setNumber));
+    request.send();
+}
+
+function filterElements(elementId) {
+    later(function () {
+        renderElements(setElements.filter(function (element) {
+            return String(element[0]) === elementId;
+        }));
+    });
+}
+
+function saveBag() {
+    var bag = {};
+    document.querySelectorAll('.bag-item').forEach(function (item) {
+        bag[item.getAttribute('data-element-id')] = item.querySelector('select').value;
+    });
+    var request = new XMLHttpRequest();
+    request.open('POST', '/api/bag');
+    request.setRequestHeader('Content-Type', 'application/json');
+    request.send(JSON.stringify(bag));
+}
+
+function showBagItem(elementId, selected) {
+    var options = '';
+    for (var quantity = 1; quantity <= config.maxQuantity; quantity++) {
+        options += '<option' + (quantity === selected ? ' selected' : '') + '>' +
+            quantity + '</option>';
+    }
+    var item = document.createElement('div');
+    item.className = 'bag-item';
+    item.setAttribute('data-element-id', elementId);
+    item.innerHTML = '<span>' + elementId + '</span><select onchange="saveBag()">' + options +
+        '</select><button class="bag-item__remove" onclick="removeFromBag(this)">Remove</button>';
+    document.getElementById('bag').appendChild(item);
+}
+
+function addToBag(elementId) {
+    later(function () {
+        showBagItem(elementId, 1);
+        saveBag();
+    });
+}
+
+function removeFromBag(button) {
+    var item = button.parentNode;
+    item.parentNode.removeChild(item);
+    saveBag();
+}
+
+function onEnter(selector, callback) {
+    document.querySelector(selector).addEventListener('keydown', function (event) {
+        if (event.key === 'Enter') {
+            callback(event.target.value.trim());
+        }
+    });
+}
+
+showLinks();
+Object.keys(config.bag).forEach(function (elementId) {
+    showBagItem(elementId, parseInt(config.bag[elementId], 10));
+});
+if (hasCookie('fakeshop_cookies')) {
+    document.getElementById('cookie-banner').className = 'hidden';
+}
+if (hasCookie('fakeshop_age')) {
+    passAgeGate();
+} else {
+    onEnter('input[name=rpAgeAndCountryAgeField]', function () {
+        setCookie('fakeshop_age');
+        passAgeGate();
+    });
+}
+onEnter('.product-search input', selectSet);
+onEnter('#element-filter', filterElements);
+</script>
+</body>
+</html>
+"""
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>LEGO ID (fake shop)</title></head>
+<body>
+<div id="accountLoader" style="display: none">Loading...</div>
+<input type="text" id="fieldUsername">
+<input type="password" id="fieldPassword">
+<button id="buttonSubmitLogin" onclick="parent.loggedIn()">Log in</button>
+</body>
+</html>
+"""
+
+
+def default_catalogs(datafile=None, refresh_datafile=None, electric_datafile=None):
+    """
+    Build catalogs like the real shop's from the data files: each set
+    offers the parts of its combined list column under their newest
+    element ID, except for electric parts.
+
+    return dict, set number -> {element ID: in stock}
+    """
+    matrix = inventory.InventoryMatrix.load(
+        datafile or os.path.join(RAW_DATA, 'Lego Mindstorms EV3 combined list.csv'))
+    refresh = inventory.compiled_table(
+        refresh_datafile or os.path.join(RAW_DATA, 'elementid-refresh.csv'),
+        inventory.load_elementid_refresh)
+    electric = inventory.compiled_table(
+        electric_datafile or os.path.join(RAW_DATA, 'Electric-parts.csv'),
+        inventory.load_electric_parts)
+
+    catalogs = {}
+    for set_no in matrix.sets:
+        catalog = catalogs[set_no] = {}
+        for part_no, quantity in zip(matrix.part_numbers, matrix.column(set_no)):
+            if quantity <= 0 or electric.find(part_no) is not None:
+                continue
+            row = refresh.find(part_no)
+            if row is not None:
+                # 0 means the part isn't sold separately any longer
+                part_no = int(refresh.string(0, row).split(',')[-1])
+            if part_no:
+                catalog[part_no] = True
+    return catalogs
+
+
+def mark_out_of_stock(catalogs, fraction, seed=45544):
+    """
+    Mark a random fraction of the elements of each catalog out of stock
+    """
+    rng = random.Random(seed)
+    for catalog in catalogs.values():
+        for element_id in sorted(catalog):
+            if rng.random() < fraction:
+                catalog[element_id] = False
+
+
+class FakeShop:
+    """
+    Fake replacement parts shop served by a local HTTP server thread.
+
+    ``latency`` (seconds) delays set selection, searches and adding to the
+    bag in the page, ``page_latency`` delays every page load.  Without
+    ``element_list`` a set's elements only show up when searched for.
+    The shopping bag (element ID -> quantity) is kept in ``bag`` across
+    page loads, like that of a logged-in customer.  The set numbers the page
+    asked for are listed in ``selected_sets``.
+    """
+
+    def __init__(self, catalogs, latency=0, page_latency=0, element_list=True, max_quantity=200):
+        self.catalogs = {str(set_no): catalog for set_no, catalog in catalogs.items()}
+        self.latency = latency
+        self.page_latency = page_latency
+        self.element_list = element_list
+        self.max_quantity = max_quantity
+        self.bag = {}
+        self.selected_sets = []
+
+        self.server = None
+        self.url = None
+
+    def start(self, host='127.0.0.1', port=0):
+        """
+        Serve the shop in a background thread
+
+        return string, the base URL of the shop
+        """
+        shop = self
+
+        class Handler(ShopRequestHandler):
+            fake_shop = shop
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = 'http://%s:%s/' % self.server.server_address[:2]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        """
+        Shut the server down
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def sale_page(self):
+        config = json.dumps({
+            'latency': int(self.latency * 1000),
+            'elementList': self.element_list,
+            'maxQuantity': self.max_quantity,
+            'bag': self.bag,
+        })
+        return SALE_PAGE % {'config': config}
+
+    def set_elements(self, set_no):
+        catalog = self.catalogs.get(set_no)
+        if catalog is None:
+            return None
+        return [[element_id, in_stock, 'Element %s' % element_id, self.price(element_id)]
+                for element_id, in_stock in sorted(catalog.items())]
+
+    @staticmethod
+    def price(element_id):
+        return '$%.2f' % (.05 + element_id % 97 / 100)
+
+
+class ShopRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the pages and the set API of a FakeShop
+    """
+    fake_shop = None
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+
+        if path.startswith('/api/sets/'):
+            self.fake_shop.selected_sets.append(path[len('/api/sets/'):])
+            elements = self.fake_shop.set_elements(path[len('/api/sets/'):])
+            if elements is None:
+                self.respond(404, 'application/json', '[]')
+            else:
+                self.respond(200, 'application/json', json.dumps(elements))
+            return
+
+        time.sleep(self.fake_shop.page_latency)
+
+        if path.endswith('/service/replacementparts/sale'):
+            self.respond(200, 'text/html', self.fake_shop.sale_page())
+        elif path == '/legoid/login':
+            self.respond(200, 'text/html', LOGIN_PAGE)
+        else:
+            self.respond(404, 'text/plain', 'Not found')
+
+    def do_POST(self):
+        if urlsplit(self.path).path == '/api/bag':
+            length = int(self.headers.get('Content-Length', 0))
+            self.fake_shop.bag = json.loads(self.rfile.read(length).decode('utf-8'))
+            self.respond(204, 'application/json', '')
+        else:
+            self.respond(404, 'text/plain', 'Not found')
+
+    def respond(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = ArgumentParser(description="Serve a fake LEGO replacement parts shop locally.")
+    parser.add_argument('--port', type=int, default=8000,
+                        help="Port to listen on. Default: 8000")
+    parser.add_argument('--catalog',
+                        help="JSON file with {set number: {element ID: in stock}} catalogs."
+                             " Default: built from the files in raw-data")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="Seconds for set selection, searches and adding to the bag."
+                             " Default: 0")
+    parser.add_argument('--page-latency', type=float, default=0,
+                        help="Seconds for every page load. Default: 0")
+    parser.add_argument('--out-of-stock', type=float, default=0,
+                        help="Fraction of elements out of stock. Default: 0")
+    parser.add_argument('--no-element-list', dest='element_list', action='store_false',
+                        help="Only show elements when they're searched for")
+    args = parser.parse_args()
+
+    if args.catalog:
+        with open(args.catalog) as f:
+            catalogs = {set_no: {int(element_id): in_stock
+                                 for element_id, in_stock in catalog.items()}
+                        for set_no, catalog in json.load(f).items()}
+    else:
+        catalogs = default_catalogs()
+    mark_out_of_stock(catalogs, args.out_of_stock)
+
+    shop = FakeShop(catalogs, args.latency, args.page_latency, args.element_list)
+    url = shop.start(port=args.port)
+    print("Serving a fake LEGO shop for sets {sets} at {url}".format(
+        sets=', '.join(sorted(catalogs)), url=url), file=sys.stderr)
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        shop.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1372 @@
+#!/usr/bin/env python3
+#
+#    LEGO Mindstorms Editions Pieces Comparison
+#    Copyright (C) 2015-2018  Peter Bittner <django@bittner.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Readers and merge engine for LEGO inventory data files.
+"""
+import glob
+import hashlib
+import json
+import mmap
+import os
+import os.path
+import re
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from operator import sub
+
+
+INDEX_MAGIC = b'LEGOIDX2'
+INDEX_SUFFIX = '.idx'
+# magic, source mtime (ns), source size, source SHA-1, loader version,
+# rows, integer columns, string columns, labels, strings
+INDEX_HEADER = struct.Struct('<8sqq20sIIIIII')
+
+DUMP_CHUNK_SIZE = 2**20
+
+DATABASE_MAGIC = b'SQLite format 3\x00'
+DATABASE_VERSION = 3  # replaced_by index
+DATABASE_TABLES = ['sets', 'parts', 'inventories', 'replacements', 'replaced_by',
+                   'electric_parts']
+# integer and string columns of the tables of index loaders, see DatabaseTable
+DATABASE_TABLE_COLUMNS = {
+    'replacements': (['element_id'], ['new_element_ids', 'comment', 'closure']),
+    'electric_parts': (['element_id', 'standalone_set'], ['design_id']),
+}
+DATABASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sets (
+    position INTEGER PRIMARY KEY, set_no TEXT NOT NULL, column_name TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS sets_set_no ON sets (set_no);
+
+CREATE TABLE IF NOT EXISTS parts (
+    element_id INTEGER PRIMARY KEY, design_id TEXT, name TEXT, image TEXT);
+CREATE INDEX IF NOT EXISTS parts_design_id ON parts (design_id);
+
+CREATE TABLE IF NOT EXISTS inventories (
+    position INTEGER NOT NULL, element_id INTEGER NOT NULL, quantity INTEGER NOT NULL,
+    PRIMARY KEY (position, element_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS inventories_element_id ON inventories (element_id);
+
+CREATE TABLE IF NOT EXISTS replacements (
+    element_id INTEGER PRIMARY KEY, new_element_ids TEXT, comment TEXT, closure TEXT);
+CREATE TABLE IF NOT EXISTS replaced_by (
+    new_element_id INTEGER NOT NULL, element_id INTEGER NOT NULL,
+    PRIMARY KEY (new_element_id, element_id)) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS electric_parts (
+    element_id INTEGER PRIMARY KEY, design_id TEXT, standalone_set INTEGER);
+CREATE INDEX IF NOT EXISTS electric_parts_design_id ON electric_parts (design_id);
+"""
+
+
+def read_brickset(datafile):
+    """
+    Generate (part_no, quantity, design_id, part_name, image_url) tuples
+    from a Brickset inventory export, reading one line at a time.
+    """
+    with open(datafile) as f:
+        next(f, None)  # skip header line
+        for line in f:
+            line = line.strip()
+            try:
+                (set_no, part_no, quantity, color, category, design_id,
+                 part_name, image_url, set_count) = line.split('\t')
+
+                part_no, quantity = int(part_no), int(quantity)
+            except ValueError as err:
+                print('Ignoring error: %s (%s)' % (err, line),
+                      file=sys.stderr)
+                continue
+
+            yield part_no, quantity, design_id, part_name, image_url
+
+
+def read_element_list(datafile):
+    """
+    Generate (part_no, quantity, design_id, part_name, image_url) tuples
+    from a LEGO element list (a title line, ``Element List`` and
+    ``quantity<TAB>element ID`` rows), which has no design IDs, names or
+    images.
+    """
+    with open(datafile) as f:
+        next(f, None)  # skip title line
+        next(f, None)  # skip "Element List" line
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                quantity, part_no = line.split('\t')
+                part_no, quantity = int(part_no), int(quantity)
+            except ValueError as err:
+                print('Ignoring error: %s (%s)' % (err, line),
+                      file=sys.stderr)
+                continue
+
+            yield part_no, quantity, '', '', ''
+
+
+def read_part_names(datafile):
+    """
+    Generate (element ID, part name) tuples from a part name list
+    (``name<TAB>element ID`` rows)
+    """
+    with open(datafile) as f:
+        for line in f:
+            line = line.strip()
+            try:
+                part_name, part_no = line.rsplit('\t', 1)
+                part_no = int(part_no)
+            except ValueError as err:
+                if line:
+                    print('Ignoring error: %s (%s)' % (err, line),
+                          file=sys.stderr)
+                continue
+
+            yield part_no, part_name
+
+
+def sniff_format(datafile):
+    """
+    Tell the format of an inventory data file from its first two lines:
+    ``brickset`` (Brickset inventory export), ``element-list`` (LEGO
+    element list), ``part-names`` (part name list), or None if unknown.
+    """
+    try:
+        with open(datafile) as f:
+            first_line = f.readline().rstrip('\n')
+            second_line = f.readline().rstrip('\n')
+    except (OSError, UnicodeDecodeError):
+        return None
+
+    fields = first_line.split('\t')
+    if fields[:2] == ['SetNumber', 'PartID']:
+        return 'brickset'
+    if second_line.strip() == 'Element List':
+        return 'element-list'
+    if len(fields) == 2 and fields[1].strip().isdigit() and not fields[0].isdigit():
+        return 'part-names'
+    return None
+
+
+INVENTORY_READERS = {
+    'brickset': read_brickset,
+    'element-list': read_element_list,
+}
+
+
+def read_inventory(datafile):
+    """
+    Generate the (part_no, quantity, design_id, part_name, image_url)
+    tuples of an inventory, with the reader of its (sniffed) format
+    """
+    file_format = sniff_format(datafile)
+    if file_format not in INVENTORY_READERS:
+        raise SystemExit("Unknown inventory format: %s" % datafile)
+    return INVENTORY_READERS[file_format](datafile)
+
+
+def inventory_column(datafile, file_format):
+    """
+    The combined list column of an inventory: its file name, or the title
+    line of an element list, e.g. ``Lego Mindstorms, 31313 EV3 Home
+    Edition``, which has the set number (see set_number).
+    """
+    if file_format == 'element-list':
+        with open(datafile) as f:
+            return f.readline().strip().replace('\t', ' ')
+    return datafile
+
+
+def read_line_chunks(file_handler, chunk_size=DUMP_CHUNK_SIZE):
+    """
+    Generate lists of the lines (bytes, without line ends) in the chunks
+    read from a binary file
+    """
+    rest = b''
+    for chunk in iter(lambda: file_handler.read(chunk_size), b''):
+        lines = (rest + chunk).split(b'\n')
+        rest = lines.pop()
+        yield lines
+    if rest:
+        yield [rest]
+
+
+def read_brickset_dump(dumpfile, sets, stats=None):
+    """
+    Generate (column, part_no, quantity, design_id, part_name, image_url)
+    tuples from a full Brickset inventory dump, for the rows of the given
+    sets (``31313-1`` or a version of ``31313``) only.  A set number
+    without version gets the first version in the dump, other versions of
+    it are ignored with a warning.
+
+    The dump is read in chunks of bytes, and only the rows kept are
+    decoded and split.  ``stats``, if given, is filled with the number of
+    ``bytes`` and ``rows`` read and of the rows ``kept``.
+    """
+    wanted = {set_no: column for column, set_no in enumerate(sets)}
+    columns = {}  # SetNumber -> column, or None for sets not wanted
+    versions = {}  # column -> SetNumber read into it
+    rows = kept = 0
+
+    with open(dumpfile, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        f.readline()  # skip header line
+        for lines in read_line_chunks(f):
+            rows += len(lines)
+
+            for line in lines:
+                set_key = line[:line.find(b'\t')]
+                try:
+                    column = columns[set_key]
+                except KeyError:
+                    set_no = set_key.decode(errors='replace')
+                    column = wanted.get(set_no)
+                    if column is None:
+                        column = wanted.get(set_no.split('-')[0])
+                        if column is not None and column in versions:
+                            print('Ignoring set %s, reading %s for %s already' % (
+                                set_no, versions[column], sets[column]), file=sys.stderr)
+                            column = None
+                    if column is not None:
+                        versions[column] = set_no
+                    columns[set_key] = column
+                if column is None:
+                    continue
+
+                try:
+                    line = line.decode().strip()
+                    (set_no, part_no, quantity, color, category, design_id,
+                     part_name, image_url, set_count) = line.split('\t')
+
+                    part_no, quantity = int(part_no), int(quantity)
+                except ValueError as err:
+                    print('Ignoring error: %s (%s)' % (err, line),
+                          file=sys.stderr)
+                    continue
+
+                kept += 1
+                yield column, part_no, quantity, design_id, part_name, image_url
+
+    if stats is not None:
+        stats.update(bytes=size, rows=rows, kept=kept)
+
+
+class CombinedList:
+    """
+    Inventory of several LEGO sets combined, one quantity column per set.
+
+    The design ID, name and image of a part are those of the first
+    inventory that has them.
+
+    Memory grows with the number of distinct parts, not with the size of
+    the input files: every part keeps its descriptive fields once and its
+    quantities in a compact array of machine integers.
+
+    With a ``sources`` dict the column each field of a part was taken from
+    is kept in it as well (-1 for none, the number of columns for the part
+    names), so that columns can be spliced in later.  The quantities of a
+    list read back for that are kept as text, they're only written again.
+    """
+
+    def __init__(self, columns, sources=None):
+        self.columns = list(columns)
+        self.parts = {}
+        self.sources = sources
+
+    @classmethod
+    def read(cls, lines):
+        """
+        Read a combined list written by write, with quantities as text
+        """
+        lines = iter(lines)
+        combined = cls(next(lines).rstrip('\n').split('\t')[2:-2])
+        for line in lines:
+            fields = line.rstrip('\n').split('\t')
+            combined.parts[int(fields[0])] = (fields[1], fields[-2], fields[-1], fields[2:-2])
+        return combined
+
+    def add(self, column, part_no, quantity, design_id, part_name, image_url):
+        """
+        Set the quantity of a part in a column, registering new parts
+        """
+        part = self.parts.get(part_no)
+        if part is None:
+            part = self.parts[part_no] = (
+                design_id, part_name, image_url, array('i', [0]) * len(self.columns))
+        elif not (part[0] and part[1] and part[2]):
+            part = self.parts[part_no] = (
+                part[0] or design_id, part[1] or part_name, part[2] or image_url, part[3])
+
+        part[3][column] = quantity
+
+    def update(self, column, rows):
+        """
+        Merge the rows of an inventory reader into a column
+        """
+        parts = self.parts
+        sources = self.sources
+        no_parts = array('i', [0]) * len(self.columns)
+
+        for part_no, quantity, design_id, part_name, image_url in rows:
+            part = parts.get(part_no)
+            if part is None:
+                part = parts[part_no] = (design_id, part_name, image_url, no_parts[:])
+                if sources is not None:
+                    sources[part_no] = [column if field else -1 for field in part[:3]]
+            elif not (part[0] and part[1] and part[2]):
+                # fields an earlier file (e.g. an element list) doesn't have
+                if sources is not None:
+                    sources[part_no] = [
+                        column if field and not old else source for field, old, source in
+                        zip((design_id, part_name, image_url), part, sources[part_no])]
+                part = parts[part_no] = (
+                    part[0] or design_id, part[1] or part_name, part[2] or image_url, part[3])
+            part[3][column] = quantity
+
+    def splice(self, columns, zero_parts=()):
+        """
+        Replace whole columns (dict column -> read_partial rows of its new
+        inventory) of a combined list read back with its sources, as if it
+        was built from the new inventories.  Parts no inventory lists any
+        longer are dropped, unless in ``zero_parts``, listed with quantity 0
+        by others.
+
+        return boolean, False if a changed column was the first to have a
+        field of a part and doesn't have it any longer: the next column
+        having it is unknown, the list has to be built from all files
+        """
+        parts = self.parts
+        sources = self.sources
+        listed = set(zero_parts)
+
+        for part in parts.values():
+            for column in columns:
+                part[3][column] = '0'
+
+        for column in sorted(columns):
+            for part_no, quantity, *fields in columns[column]:
+                listed.add(part_no)
+                part = parts.get(part_no)
+                if part is None:
+                    part = parts[part_no] = (*fields, ['0'] * len(self.columns))
+                    sources[part_no] = [column if field else -1 for field in fields]
+                else:
+                    # the first column having a field, the part names come last
+                    part_sources = sources[part_no]
+                    new_fields = list(part[:3])
+                    for index, field in enumerate(fields):
+                        if field and not 0 <= part_sources[index] < column:
+                            new_fields[index] = field
+                            part_sources[index] = column
+                    part = parts[part_no] = (*new_fields, part[3])
+                part[3][column] = str(quantity)
+
+        for part_no in [part_no for part_no, part in parts.items() if part_no not in listed and
+                        all(quantity == '0' for quantity in part[3])]:
+            del parts[part_no]
+            del sources[part_no]
+
+        fields = {column: {row[0]: row[2:] for row in rows} for column, rows in columns.items()}
+        for part_no, part_sources in sources.items():
+            for index, source in enumerate(part_sources):
+                if source in fields and not fields[source].get(part_no, ('', '', ''))[index]:
+                    return False
+        return True
+
+    def join_names(self, names):
+        """
+        Fill in the part names no inventory had from a dict of element ID ->
+        part name
+        """
+        for part_no, (design_id, part_name, image_url, counts) in self.parts.items():
+            if not part_name and part_no in names:
+                self.parts[part_no] = (design_id, names[part_no], image_url, counts)
+                if self.sources is not None:
+                    self.sources[part_no][1] = len(self.columns)
+
+    def write(self, output=None):
+        """
+        Write the combined list sorted by part number, row by row
+        """
+        if output is None:
+            output = sys.stdout
+
+        print('Part no.\tLego ID\t%s\tPart name\tImage' % '\t'.join(self.columns),
+              file=output)
+        for part_no in sorted(self.parts):
+            design_id, part_name, image_url, counts = self.parts[part_no]
+            if not isinstance(counts, list):
+                # not read back as text
+                counts = map(str, counts)
+            print('%s\t%s\t%s\t%s\t%s' % (
+                part_no, design_id, '\t'.join(counts), part_name, image_url), file=output)
+
+
+def read_partial(datafile):
+    """
+    Read an inventory into a list of (part_no, quantity, design_id,
+    part_name, image_url) tuples, one per distinct part, with the same
+    first-name, last-quantity rules as CombinedList.
+    """
+    partial = {}
+    for part_no, quantity, design_id, part_name, image_url in read_inventory(datafile):
+        row = partial.get(part_no)
+        if row is None:
+            partial[part_no] = (part_no, quantity, design_id, part_name, image_url)
+        else:
+            partial[part_no] = (part_no, quantity, row[2] or design_id, row[3] or part_name,
+                                row[4] or image_url)
+    return list(partial.values())
+
+
+def expand_datafiles(paths, pattern='Brickset-inventory-*.csv'):
+    """
+    Replace directories in a list of paths by the inventory files they contain
+    """
+    datafiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            datafiles += sorted(glob.glob(os.path.join(path, pattern)))
+        else:
+            datafiles.append(path)
+    return datafiles
+
+
+def merge(datafiles, output=None, jobs=1):
+    """
+    Stream any number of Brickset inventory files into a combined list,
+    and write it.
+    """
+    combined = combine(datafiles, jobs)
+    combined.write(output)
+    return combined
+
+
+def extract(dumpfiles, sets):
+    """
+    Stream full Brickset inventory dumps into a CombinedList of the given
+    sets, one column each, reporting the throughput of every dump.
+    """
+    combined = CombinedList(sets)
+    found = set()
+
+    for name in dumpfiles:
+        print('Reading dump: %s' % name, file=sys.stderr)
+        stats = {}
+        start = time.perf_counter()
+        for column, *row in read_brickset_dump(name, sets, stats):
+            combined.add(column, *row)
+            found.add(column)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+
+        print('Kept %d of %d rows, %.1f MB in %.2f s (%.1f MB/s)' % (
+            stats['kept'], stats['rows'], stats['bytes'] / 2**20, elapsed,
+            stats['bytes'] / 2**20 / elapsed), file=sys.stderr)
+
+    for column, set_no in enumerate(sets):
+        if column not in found:
+            print('Set %s is not in the dumps' % set_no, file=sys.stderr)
+
+    return combined
+
+
+def sort_datafiles(datafiles):
+    """
+    Sniff the format of data files (see sniff_format), ignoring files of
+    unknown format
+
+    return (part name files, inventory files, their column names)
+    """
+    name_files = []
+    inventories = []
+    columns = []
+    for name in datafiles:
+        file_format = sniff_format(name)
+        if file_format == 'part-names':
+            name_files.append(name)
+        elif file_format is None:
+            print('Ignoring file of unknown format: %s' % name, file=sys.stderr)
+        else:
+            inventories.append(name)
+            columns.append(inventory_column(name, file_format))
+    if not inventories:
+        raise SystemExit("No inventory files to combine.")
+    return name_files, inventories, columns
+
+
+def read_names(name_files):
+    """
+    Read part name files into one dict of element ID -> part name
+    """
+    names = {}
+    for name in name_files:
+        print('Reading part names: %s' % name, file=sys.stderr)
+        names.update(read_part_names(name))
+    return names
+
+
+def combine(datafiles, jobs=1):
+    """
+    Stream any number of inventory files into a CombinedList.
+
+    Their format is sniffed (see sniff_format): the names of part name
+    files are joined with the parts without a name by element ID, files of
+    unknown format are ignored.
+
+    With more than one job the files are parsed in worker processes and
+    merged in the order given, so the result does not depend on ``jobs``.
+    """
+    name_files, datafiles, columns = sort_datafiles(datafiles)
+    combined = CombinedList(columns)
+
+    if jobs == 1:
+        for column, name in enumerate(datafiles):
+            print('Reading file: %s' % name, file=sys.stderr)
+            combined.update(column, read_inventory(name))
+    else:
+        with ProcessPoolExecutor(jobs or None) as executor:
+            chunksize = max(1, len(datafiles) // (4 * (jobs or os.cpu_count() or 1)))
+            partials = executor.map(read_partial, datafiles, chunksize=chunksize)
+            for column, (name, rows) in enumerate(zip(datafiles, partials)):
+                print('Merging file: %s' % name, file=sys.stderr)
+                combined.update(column, rows)
+
+    combined.join_names(read_names(name_files))
+    return combined
+
+
+def combine_incremental(datafiles, state, jobs=1):
+    """
+    Update the combined list of the last build recorded in a BuildState
+    with the inventory files that changed since, splicing their columns
+    into it.
+
+    All files are read again when the list of files changed, a part name
+    file changed, the output was changed by someone else, or a changed file
+    no longer has a field of a part it was the first to have.
+
+    return CombinedList, or None if no file changed
+    """
+    name_files, datafiles, columns = sort_datafiles(datafiles)
+    changed = [name for name in datafiles if state.changed(name)]
+    previous = None
+    if state.built_from(datafiles, name_files):
+        if not changed:
+            print('Unchanged files: %s, nothing to do' % len(datafiles), file=sys.stderr)
+            return None
+        previous = state.previous(len(datafiles))
+
+    rows = {}
+
+    def read(names):
+        if jobs == 1 or len(names) < 2:
+            results = map(read_contribution, names)
+        else:
+            with ProcessPoolExecutor(jobs or None) as executor:
+                results = list(executor.map(read_contribution, names, chunksize=max(
+                    1, len(names) // (4 * (jobs or os.cpu_count() or 1)))))
+        for name, (stat, digest, partial) in zip(names, results):
+            print('Reading file: %s' % name, file=sys.stderr)
+            state.record(name, stat, digest, partial)
+            rows[datafiles.index(name)] = partial
+
+    if previous is None:
+        read(datafiles)
+    else:
+        read(changed)
+        print('Unchanged files: %s' % (len(datafiles) - len(changed)), file=sys.stderr)
+        if not previous.splice(rows, state.zero_parts(set(datafiles) - set(changed))):
+            print('A changed file was the first to have a part field it lost,'
+                  ' reading all files', file=sys.stderr)
+            previous = None
+            read([name for name in datafiles if name not in changed])
+
+    combined = previous
+    if combined is None:
+        combined = CombinedList(columns, sources={})
+        for column in range(len(datafiles)):
+            combined.update(column, rows[column])
+
+    for name in name_files:
+        state.record(name, os.stat(name), file_digest(name))
+    combined.join_names(read_names(name_files))
+
+    state.columns, state.name_files, state.sources = datafiles, name_files, combined.sources
+    return combined
+
+
+def read_contribution(datafile):
+    """
+    Read an inventory for a BuildState: its stat, content digest and
+    read_partial rows
+    """
+    stat = os.stat(datafile)
+    return stat, file_digest(datafile), read_partial(datafile)
+
+
+class BuildState:
+    """
+    Stat and content digest of the files a combined list was built from,
+    and the column each part field was taken from, saved next to the output
+    as JSON, so that the next build only reads the inventory files that
+    changed and splices their columns into the output.
+    """
+
+    version = 3  # a record per file, the output is read back
+
+    def __init__(self, output):
+        self.output = output
+        self.filename = output + '.state.json'
+        self.inputs = {}
+        self.columns = []
+        self.name_files = []
+        self.sources = {}
+        self.output_stat = None
+
+        try:
+            with open(self.filename) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if state.get('version') == self.version:
+            self.inputs = state['inputs']
+            self.columns = state['columns']
+            self.name_files = state['name_files']
+            self.sources = state['sources']
+            self.output_stat = state['output']
+
+    def changed(self, datafile):
+        """
+        Tell if a data file changed since the last build
+        """
+        entry = self.inputs.get(datafile)
+        if entry is None:
+            return True
+
+        stat = os.stat(datafile)
+        if (entry['mtime_ns'], entry['size']) == (stat.st_mtime_ns, stat.st_size):
+            return False
+
+        if entry['digest'] == file_digest(datafile).hex():
+            # same content with a new timestamp, e.g. after a download
+            entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+            return False
+
+        return True
+
+    def built_from(self, datafiles, name_files):
+        """
+        Tell if the output was built from the same files, the part name
+        files unchanged, and hasn't been changed since
+        """
+        if (self.columns, self.name_files) != (datafiles, name_files):
+            return False
+        if any(self.changed(name) for name in name_files):
+            return False
+        try:
+            stat = os.stat(self.output)
+        except OSError:
+            return False
+        return self.output_stat == [stat.st_mtime_ns, stat.st_size]
+
+    def previous(self, columns):
+        """
+        The combined list of the last build, with its sources, if it has
+        the given number of columns
+
+        return CombinedList or None
+        """
+        if is_database(self.output):
+            database = PartDatabase(self.output)
+            combined = database.combined_list()
+            database.close()
+        else:
+            with open(self.output) as f:
+                combined = CombinedList.read(f)
+        if len(combined.columns) != columns:
+            return None
+
+        combined.sources = {int(part_no): sources for part_no, sources in self.sources.items()}
+        return combined
+
+    def zero_parts(self, datafiles):
+        """
+        Parts the given files list with quantity 0
+
+        return set of int
+        """
+        return {part_no for name in datafiles for part_no in self.inputs[name]['zero_parts']}
+
+    def record(self, datafile, stat, digest, rows=()):
+        """
+        Remember the stat and digest of a data file, and the parts it lists
+        with quantity 0, which are in the combined list without a quantity
+        """
+        self.inputs[datafile] = dict(
+            mtime_ns=stat.st_mtime_ns, size=stat.st_size, digest=digest.hex(),
+            zero_parts=[part_no for part_no, quantity, *_ in rows if not quantity])
+
+    def save(self):
+        """
+        Write the state of the files of this build, along with the stat of
+        the output written from it
+        """
+        stat = os.stat(self.output)
+        state = dict(version=self.version, output=[stat.st_mtime_ns, stat.st_size],
+                     columns=self.columns, name_files=self.name_files,
+                     inputs={name: self.inputs[name] for name in self.columns + self.name_files},
+                     sources=self.sources)
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.filename) or '.',
+                                             delete=False) as f:
+                f.write(json.dumps(state, separators=(',', ':')))
+            os.replace(f.name, self.filename)
+        except OSError as err:
+            print('Cannot write build state %s (%s)' % (self.filename, err), file=sys.stderr)
+
+
+def load_combined_list(datafile):
+    """
+    Load the output of the parse command as index rows: the set numbers,
+    the (part_no, quantities...) rows sorted by part number and the
+    matching (lego_id, part_name, image_url) rows.
+    """
+    with open(datafile) as f:
+        header = f.readline().rstrip('\n').split('\t')
+        sets = [set_number(name) for name in header[2:-2]]
+        rows = []
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            rows.append((tuple(map(int, [fields[0]] + fields[2:-2])),
+                         (fields[1], fields[-2], fields[-1])))
+
+    rows.sort()
+    return sets, [ints for ints, strings in rows], [strings for ints, strings in rows]
+
+
+def replacement_closure(chains):
+    """
+    Transitive closure of element ID replacements: every element ID an
+    original one is replaced by, directly or through other replacements,
+    nearest first.  A replacement leading back to its original is a cycle.
+    Element ID 0 (not sold any more) is only kept as a direct replacement.
+
+    return (dict original -> list of element IDs, list of originals in cycles)
+
+    >>> replacement_closure({1: [2], 2: [3, 0], 3: [1]})
+    ({1: [2, 3], 2: [3, 0, 1], 3: [1, 2]}, [1, 2, 3])
+    >>> replacement_closure({100: [100]})
+    ({100: []}, [100])
+    """
+    closures = {}
+    cycles = []
+
+    for origin, chain in chains.items():
+        seen = {origin}
+        closure = []
+        queue = deque(chain)
+        while queue:
+            part_no = queue.popleft()
+            if part_no == origin and origin not in cycles:
+                cycles.append(origin)
+            if part_no in seen:
+                continue
+            seen.add(part_no)
+            closure.append(part_no)
+            queue.extend(new_part_no for new_part_no in chains.get(part_no, ()) if new_part_no)
+        closures[origin] = closure
+
+    return closures, cycles
+
+
+def split_part_nos(text):
+    """
+    Part numbers of a comma separated list, which may be empty
+
+    >>> split_part_nos('4611705,6000593')
+    [4611705, 6000593]
+    >>> split_part_nos('')
+    []
+    """
+    return [int(part_no) for part_no in text.split(',') if part_no]
+
+
+def load_elementid_refresh(datafile):
+    """
+    Load the new element ID list as index rows: (original part no,)
+    and (comma separated new part nos, comment, comma separated new
+    part nos of the transitive closure)
+    """
+    chains = {}
+    comments = {}
+    with open(datafile) as file_handler:
+        next(file_handler, None)  # skip header line
+        for line in file_handler:
+            line = line.strip()
+            eid_origin, eid_chain, eid_comment = line.split(';')
+            # convert each new element id of eid_chain as number
+            chains[int(eid_origin)] = list(map(int, eid_chain.split(',')))
+            comments[int(eid_origin)] = eid_comment
+
+    closures, cycles = replacement_closure(chains)
+    for origin in cycles:
+        print('Element ID %s is replaced by itself in a cycle (%s)' % (origin, datafile),
+              file=sys.stderr)
+
+    origins = sorted(chains)
+    return [], [(origin,) for origin in origins], [
+        (','.join(map(str, chains[origin])), comments[origin],
+         ','.join(map(str, closures[origin])))
+        for origin in origins]
+
+
+load_elementid_refresh.version = 2  # closure column, without 0 reached indirectly
+load_elementid_refresh.table = 'replacements'
+
+
+def load_electric_parts(datafile):
+    """
+    Load the electric part list as index rows: (part no, standalone set)
+    and (design ID,)
+    """
+    entries = {}
+    with open(datafile) as file_handler:
+        next(file_handler, None)  # skip header line
+        for line in file_handler:
+            partno, legoid, legoshop_set = line.split('\t')
+            entries[int(partno)] = (int(legoshop_set), legoid)
+
+    partnos = sorted(entries)
+    return ([], [(partno, entries[partno][0]) for partno in partnos],
+            [(entries[partno][1],) for partno in partnos])
+
+
+load_electric_parts.version = 1  # design ID column
+load_electric_parts.table = 'electric_parts'
+
+
+def set_number(column_name):
+    """
+    Extract the LEGO set number from a combined list column name,
+    e.g. ``Brickset-inventory-31313-1.csv`` or ``Lego Mindstorms, 31313 EV3
+    Home Edition`` -> ``31313``.
+    """
+    name = os.path.basename(column_name)
+    match = re.search(r'(\d+)-\d+', name) or re.search(r'\b(\d{4,})\b', name)
+    if match:
+        return match.group(1)
+    return os.path.splitext(name)[0]
+
+
+class InventoryMatrix:
+    """
+    Part x set quantity matrix of a combined list.
+
+    Part numbers are kept in a sorted array, quantities in one array per
+    set (column), so that set algebra over many sets is a single pass
+    over a few contiguous columns.
+    """
+
+    def __init__(self, part_numbers, sets, columns):
+        self.part_numbers = part_numbers
+        self.sets = sets
+        self.columns = columns
+
+    @classmethod
+    def from_combined_list(cls, datafile):
+        """
+        Load the output of the parse command
+        """
+        sets, rows, names = load_combined_list(datafile)
+        part_numbers = array('q', [row[0] for row in rows])
+        columns = [array('i', [row[column] for row in rows])
+                   for column in range(1, len(sets) + 1)]
+        return cls(part_numbers, sets, columns)
+
+    @classmethod
+    def load(cls, datafile, sets=None):
+        """
+        Load the output of the parse command through its compiled index,
+        or from a part database, where only the ``sets`` given are read
+        """
+        if is_database(datafile):
+            return PartDatabase(datafile).matrix(sets)
+
+        table = compiled_table(datafile, load_combined_list)
+        columns = [table.ints(column) for column in range(1, len(table.labels) + 1)]
+        return cls(table.ints(0), table.labels, columns)
+
+    def column(self, set_no):
+        """
+        Quantities of all parts in a set
+        """
+        try:
+            return self.columns[self.sets.index(str(set_no))]
+        except ValueError:
+            raise SystemExit("Set {set_no} is not in the combined list. Known sets: {sets}"
+                             .format(set_no=set_no, sets=', '.join(self.sets)))
+
+    def quantity(self, part_no, set_no):
+        """
+        Quantity of a single part in a set (0 if unknown)
+        """
+        index = bisect_left(self.part_numbers, part_no)
+        if index < len(self.part_numbers) and self.part_numbers[index] == part_no:
+            return self.column(set_no)[index]
+        return 0
+
+    def total(self, sets):
+        """
+        Quantities of all parts summed over several sets
+        """
+        columns = [self.column(set_no) for set_no in sets]
+        if not columns:
+            return array('i', [0]) * len(self.part_numbers)
+        if len(columns) == 1:
+            return columns[0]
+        return array('i', map(sum, zip(*columns)))
+
+    def sets_containing(self, part_no):
+        """
+        Sets a part is in (an empty list if unknown)
+        """
+        index = bisect_left(self.part_numbers, part_no)
+        if index < len(self.part_numbers) and self.part_numbers[index] == part_no:
+            return [set_no for set_no, column in zip(self.sets, self.columns) if column[index] > 0]
+        return []
+
+    def set_index(self, part_numbers=None):
+        """
+        Inverted index of the given (or all) parts: part no -> sets it's in
+        """
+        if part_numbers is None:
+            part_numbers = self.part_numbers
+        return {part_no: self.sets_containing(part_no) for part_no in part_numbers}
+
+    def missing(self, owned, wanted):
+        """
+        List (part_no, quantity) pairs you need to buy when you own the
+        ``owned`` sets and want all pieces of the ``wanted`` sets.
+        """
+        difference = map(sub, self.total(wanted), self.total(owned))
+        return [(part_no, quantity)
+                for part_no, quantity in zip(self.part_numbers, difference)
+                if quantity > 0]
+
+
+def cover_sets(set_index, exclude=()):
+    """
+    Choose few sets that together have all parts of a set index (part no
+    -> sets), greedily the set having most of the parts left first, the
+    lowest set number on a tie.
+
+    return (list of (set, part nos) in the order chosen, part nos in none
+    of the sets that aren't excluded)
+    """
+    parts_by_set = {}
+    for part_no, sets in set_index.items():
+        for set_no in sets:
+            if set_no not in exclude:
+                parts_by_set.setdefault(set_no, set()).add(part_no)
+
+    uncovered = set().union(*parts_by_set.values())
+    unavailable = sorted(part_no for part_no in set_index if part_no not in uncovered)
+
+    cover = []
+    while uncovered:
+        set_no = max(sorted(parts_by_set), key=lambda set_no: len(parts_by_set[set_no] & uncovered))
+        parts = parts_by_set.pop(set_no) & uncovered
+        cover.append((set_no, sorted(parts)))
+        uncovered -= parts
+
+    return cover, unavailable
+
+
+def is_database(filename):
+    """
+    Tell if a file is an SQLite database, e.g. written by PartDatabase
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return f.read(len(DATABASE_MAGIC)) == DATABASE_MAGIC
+    except OSError:
+        return False
+
+
+class PartDatabase:
+    """
+    SQLite store of the combined list (parts, sets and their inventories),
+    the new element IDs and the electric parts, indexed by element ID,
+    design ID and set number.
+
+    Inventories belong to a column of the combined list, like in its text
+    file, so a set can have more than one (the first one counts).  The
+    tables of a database of an older version are dropped, to be written
+    by parse again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # shared by the lookup threads of an order, see DatabaseTable
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        version, = self.connection.execute("PRAGMA user_version").fetchone()
+        if version != DATABASE_VERSION:
+            with self.connection:
+                for table in DATABASE_TABLES:
+                    self.connection.execute("DROP TABLE IF EXISTS %s" % table)
+                self.connection.execute("PRAGMA user_version = %d" % DATABASE_VERSION)
+        self.connection.executescript(DATABASE_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def write_combined_list(self, combined):
+        """
+        Replace the parts, sets and inventories with a CombinedList's
+        """
+        sets = [(position, set_number(name), name)
+                for position, name in enumerate(combined.columns)]
+
+        with self.connection:
+            self.connection.execute("DELETE FROM sets")
+            self.connection.execute("DELETE FROM parts")
+            self.connection.execute("DELETE FROM inventories")
+            self.connection.executemany("INSERT INTO sets VALUES (?, ?, ?)", sets)
+            self.connection.executemany(
+                "INSERT INTO parts VALUES (?, ?, ?, ?)",
+                ((part_no, design_id, part_name, image_url)
+                 for part_no, (design_id, part_name, image_url, _) in combined.parts.items()))
+            self.connection.executemany(
+                "INSERT INTO inventories VALUES (?, ?, ?)",
+                ((position, part_no, int(quantity))
+                 for part_no, (_, _, _, counts) in combined.parts.items()
+                 for position, quantity in enumerate(counts) if quantity not in (0, '0')))
+
+    def combined_list(self):
+        """
+        Read the combined list back as written by write_combined_list, with
+        quantities as text like CombinedList.read
+
+        return CombinedList
+        """
+        combined = CombinedList(name for name, in self.connection.execute(
+            "SELECT column_name FROM sets ORDER BY position"))
+        for part_no, design_id, part_name, image_url in self.connection.execute(
+                "SELECT element_id, design_id, name, image FROM parts"):
+            combined.parts[part_no] = (design_id, part_name, image_url,
+                                       ['0'] * len(combined.columns))
+        for position, part_no, quantity in self.connection.execute(
+                "SELECT position, element_id, quantity FROM inventories"):
+            combined.parts[part_no][3][position] = str(quantity)
+        return combined
+
+    def write_table(self, loader, datafile):
+        """
+        Replace the rows of the table of an index loader (``loader.table``)
+        with those of a data file
+        """
+        table = loader.table
+        int_columns, str_columns = DATABASE_TABLE_COLUMNS[table]
+        _, int_rows, str_rows = loader(datafile)
+        rows = [ints + strings for ints, strings in zip(int_rows, str_rows)]
+
+        with self.connection:
+            self.connection.execute("DELETE FROM %s" % table)
+            self.connection.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ', '.join(int_columns + str_columns),
+                ', '.join('?' * len(int_columns + str_columns))), rows)
+
+            if table == 'replacements':
+                closure = str_columns.index('closure')
+                self.connection.execute("DELETE FROM replaced_by")
+                self.connection.executemany(
+                    "INSERT INTO replaced_by VALUES (?, ?)",
+                    ((new_part_no, origin)
+                     for (origin,), strings in zip(int_rows, str_rows)
+                     for new_part_no in split_part_nos(strings[closure])))
+
+    def sets(self):
+        """
+        Set numbers in the order of the combined list's columns
+        """
+        return [set_no for set_no, in
+                self.connection.execute("SELECT set_no FROM sets ORDER BY position")]
+
+    def matrix(self, sets=None):
+        """
+        InventoryMatrix of all parts, with the columns of the given (or all) sets
+        """
+        known_sets = self.sets()
+        if not known_sets:
+            raise SystemExit("The database {} has no combined list, write it with parse."
+                             .format(self.filename))
+        if sets is None:
+            sets = known_sets
+        sets = [str(set_no) for set_no in dict.fromkeys(sets)]
+
+        for set_no in sets:
+            if set_no not in known_sets:
+                raise SystemExit("Set {set_no} is not in the combined list. Known sets: {sets}"
+                                 .format(set_no=set_no, sets=', '.join(known_sets)))
+
+        part_numbers = array('q', (part_no for part_no, in self.connection.execute(
+            "SELECT element_id FROM parts ORDER BY element_id")))
+        columns = [array('i', (quantity for quantity, in self.connection.execute(
+            "SELECT coalesce(inventories.quantity, 0) FROM parts LEFT JOIN inventories"
+            " ON inventories.position = ? AND inventories.element_id = parts.element_id"
+            " ORDER BY parts.element_id", (known_sets.index(set_no),))))
+            for set_no in sets]
+
+        return InventoryMatrix(part_numbers, sets, columns)
+
+    def sets_containing(self, part_no):
+        """
+        Sets a part is in (an empty list if unknown)
+        """
+        return [set_no for set_no, in self.connection.execute(
+            "SELECT sets.set_no FROM inventories JOIN sets USING (position)"
+            " WHERE inventories.element_id = ? AND inventories.quantity > 0"
+            " ORDER BY position", (part_no,))]
+
+
+class DatabaseTable:
+    """
+    The table of an index loader (``loader.table``) in a part database,
+    looked up like a CompiledTable (find, integer, string), with a query
+    on the element ID index for each lookup.
+    """
+
+    def __init__(self, database, loader):
+        self.connection = database.connection
+        self.lock = threading.Lock()
+        self.int_columns, self.str_columns = DATABASE_TABLE_COLUMNS[loader.table]
+        self.query = "SELECT %s FROM %s WHERE element_id = ?" % (
+            ', '.join(self.int_columns + self.str_columns), loader.table)
+
+    def find(self, key):
+        """
+        Row (the values of its columns) of a key, or None
+        """
+        with self.lock:
+            return self.connection.execute(self.query, (key,)).fetchone()
+
+    def integer(self, column, row):
+        """
+        Value of an integer column in a row
+        """
+        return row[column]
+
+    def string(self, column, row):
+        """
+        Value of a string column in a row
+        """
+        return row[len(self.int_columns) + column]
+
+    def originals(self, new_part_no):
+        """
+        Element IDs replaced by a new one, directly or not (replacements)
+        """
+        with self.lock:
+            return [part_no for part_no, in self.connection.execute(
+                "SELECT element_id FROM replaced_by WHERE new_element_id = ?"
+                " ORDER BY element_id", (new_part_no,))]
+
+
+class CompiledTable:
+    """
+    Read-only table of integer and string columns in the binary index
+    format written by ``pack_compiled_table``.
+
+    Integer columns are fixed-width (64 bit) and sorted by the first
+    column, strings are references into a table of unique strings.
+    Nothing is parsed up front, so a memory-mapped index is usable
+    right away.
+    """
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        self.header = INDEX_HEADER.unpack_from(view)
+        (magic, self.mtime_ns, self.size, self.digest, self.version,
+         self.rows, int_columns, str_columns, labels, strings) = self.header
+        if magic != INDEX_MAGIC:
+            raise ValueError("Not a compiled index")
+
+        offset = INDEX_HEADER.size + -INDEX_HEADER.size % 8
+        label_refs, offset = _view(view, offset, 'I', labels)
+        ints, offset = _view(view, offset, 'q', self.rows * int_columns)
+        self._refs, offset = _view(view, offset, 'I', self.rows * str_columns)
+        self._offsets, offset = _view(view, offset, 'I', strings + 1)
+        self._blob = view[offset:]
+
+        self._ints = [ints[column * self.rows:(column + 1) * self.rows]
+                      for column in range(int_columns)]
+        self.labels = [self._string(ref) for ref in label_refs]
+
+    def __len__(self):
+        return self.rows
+
+    def _string(self, ref):
+        return str(self._blob[self._offsets[ref]:self._offsets[ref + 1]], 'utf-8')
+
+    def ints(self, column):
+        """
+        Integer column as a memoryview
+        """
+        if not self.rows:
+            return memoryview(b'').cast('q')
+        return self._ints[column]
+
+    def integer(self, column, row):
+        """
+        Value of an integer column in a row
+        """
+        return self.ints(column)[row]
+
+    def string(self, column, row):
+        """
+        Value of a string column in a row
+        """
+        return self._string(self._refs[column * self.rows + row])
+
+    def find(self, key):
+        """
+        Row index of a key in the first integer column, or None
+        """
+        keys = self.ints(0)
+        row = bisect_left(keys, key)
+        if row < len(keys) and keys[row] == key:
+            return row
+        return None
+
+
+def _view(view, offset, typecode, count):
+    """
+    Cast a slice of a byte view, return it and the next 8-byte aligned offset
+    """
+    end = offset + struct.calcsize(typecode) * count
+    return view[offset:end].cast(typecode), end + -end % 8
+
+
+def _pad(data):
+    return data + bytes(-len(data) % 8)
+
+
+def pack_compiled_table(labels, int_rows, str_rows, mtime_ns=0, size=0, digest=bytes(20),
+                        version=0):
+    """
+    Serialize a table in the binary index format.
+
+    ``int_rows`` must be sorted by their first value, ``str_rows`` has
+    the string values of the same rows (or is empty).
+    """
+    rows = len(int_rows)
+    int_columns = len(int_rows[0]) if rows else 0
+    str_columns = len(str_rows[0]) if str_rows else 0
+
+    strings = {}
+    for value in labels:
+        strings.setdefault(value, len(strings))
+    refs = array('I', [strings.setdefault(row[column], len(strings))
+                       for column in range(str_columns) for row in str_rows])
+    label_refs = array('I', [strings[value] for value in labels])
+    ints = array('q', [row[column] for column in range(int_columns) for row in int_rows])
+
+    blob = bytearray()
+    offsets = array('I', [0])
+    for value in strings:
+        blob += value.encode('utf-8')
+        offsets.append(len(blob))
+
+    header = INDEX_HEADER.pack(INDEX_MAGIC, mtime_ns, size, digest, version, rows,
+                               int_columns, str_columns, len(labels), len(strings))
+    return b''.join([_pad(header), _pad(label_refs.tobytes()), ints.tobytes(),
+                     _pad(refs.tobytes()), _pad(offsets.tobytes()), bytes(blob)])
+
+
+def file_digest(filename):
+    """
+    SHA-1 digest of a file's content
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**16), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def compiled_table(datafile, loader):
+    """
+    Return the compiled index of a data file, memory-mapped from
+    ``<datafile>.idx``, or a DatabaseTable of a part database.  The index
+    is rebuilt with ``loader(datafile)`` whenever the data file or
+    ``loader.version`` changed; it returns ``(labels, int_rows, str_rows)``
+    for ``pack_compiled_table``.
+    """
+    if is_database(datafile):
+        return DatabaseTable(PartDatabase(datafile), loader)
+
+    index_file = datafile + INDEX_SUFFIX
+    stat = os.stat(datafile)
+    version = getattr(loader, 'version', 0)
+
+    try:
+        with open(index_file, 'rb') as f:
+            table = CompiledTable(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    except (OSError, ValueError, struct.error):
+        table = None
+
+    if table is not None and table.version != version:
+        table = None
+
+    if table is not None and (table.mtime_ns, table.size) == (stat.st_mtime_ns, stat.st_size):
+        return table
+
+    digest = file_digest(datafile)
+
+    if table is not None and table.digest == digest:
+        # same content with a new timestamp, e.g. after a checkout
+        header = INDEX_HEADER.pack(INDEX_MAGIC, stat.st_mtime_ns, stat.st_size,
+                                   *table.header[3:])
+        try:
+            with open(index_file, 'r+b') as f:
+                f.write(header)
+        except OSError:
+            pass
+        return table
+
+    data = pack_compiled_table(*loader(datafile), mtime_ns=stat.st_mtime_ns,
+                               size=stat.st_size, digest=digest, version=version)
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(index_file) or '.',
+                                         suffix=INDEX_SUFFIX, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, index_file)
+    except OSError as err:
+        print('Cannot write index %s (%s)' % (index_file, err), file=sys.stderr)
+
+    return CompiledTable(data)
@@ -22,61 +22,203 @@ you have bought LEGO Mindstorms EV3 Home Edition (31313) and the Education
 Expansion Set (45560).  So you can make all robots that can be made with
 the Education Core Set (45544) + Education Expansion Set.
 """
+import csv
+import itertools
+import json
+import operator
 import os.path
 import sys
 from argparse import ArgumentParser
 
+import inventory
+
 
 SET_EV3HOME = '31313'
 SET_EDUCORE = '45544'
 SET_EDUEXPA = '45560'
 
 SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+COMBINED_LIST = os.path.join(SCRIPT_PATH, 'raw-data', 'Lego Mindstorms EV3 combined list.csv')
+NEW_ELEMENT_IDS = os.path.join(SCRIPT_PATH, 'raw-data', 'elementid-refresh.csv')
+ELECTRIC_PARTS = os.path.join(SCRIPT_PATH, 'raw-data', 'Electric-parts.csv')
+
+# file arguments, made absolute for a server running elsewhere
+PATH_ARGUMENTS = ['datafile', 'database', 'profile', 'cookies', 'trace', 'cache', 'journal']
 
 
 def main():
     parser = ArgumentParser(description="Help with calculating and ordering required"
                                         " LEGO Mindstorms EV3 spare parts.")
+    parser.add_argument('--socket', default=os.environ.get('LEGO_PIECES_SOCKET'),
+                        help="Unix socket of a server (see the serve command) to run the"
+                             " missing and order commands in. Default: $LEGO_PIECES_SOCKET")
+    parser.add_argument('--database', '-d',
+                        help="Part database (SQLite) for the parse command to write, and for"
+                             " all other commands to read the combined list, the new element"
+                             " IDs and the electric parts from")
     commands = parser.add_subparsers(metavar='command', dest='command')
     commands.required = True
 
     cmd = commands.add_parser(
-        'parse', help="Parse 3 inventory data files and combine them into a single data list."
+        'parse', help="Parse inventory data files and combine them into a single data list."
                       " You can redirect the output into a text file on the command line.")
-    cmd.add_argument('datafiles', nargs=3, help="3 inventory data files for the 3 LEGO sets")
+    cmd.add_argument('datafiles', nargs='+',
+                     help="Inventory data files, one per LEGO set, or directories containing"
+                          " Brickset-inventory-*.csv files")
+    cmd.add_argument('--output', '-o',
+                     help="Write the combined list to this file instead of stdout (not at all"
+                          " with --database)")
+    cmd.add_argument('--jobs', '-j', type=int, default=1,
+                     help="Number of worker processes reading the inventory files"
+                          " (0 = one per CPU). Default: 1")
+    cmd.add_argument('--sets', type=lambda value: value.split(','),
+                     help="Read the datafiles as full Brickset inventory dumps of all sets,"
+                          " keeping the rows of these sets only, separated by comma signs,"
+                          " e.g. 31313,45544-1")
+    cmd.add_argument('--incremental', '-i', action='store_true',
+                     help="Only read the inventory files that changed since the last"
+                          " --incremental run for the same --output (or --database), and"
+                          " splice them into it. Their stat and digest are recorded in"
+                          " <output>.state.json")
 
     cmd = commands.add_parser(
         'missing', help="Calculate the LEGO pieces missing in the combination of the Edu"
                         " Expansion set + Home or Edu Core, that only the other (omitted)"
                         " set would have.")
-    cmd.add_argument('omitted_set', choices=[SET_EV3HOME, SET_EDUCORE],
+    cmd.add_argument('omitted_set', nargs='?', choices=[SET_EV3HOME, SET_EDUCORE],
                      help="The LEGO set you did *not* buy, which you need the bricks from."
                           " 31313 = Mindstorms EV3, 45544 = Edu Core, 45560 = Edu Expansion.")
-    datafile_default = os.path.join(SCRIPT_PATH,
-                                    'raw-data', 'Lego Mindstorms EV3 combined list.csv')
-    cmd.add_argument('--datafile', '-f', default=datafile_default,
-                     help="The combined list data file. Default: {}".format(datafile_default))
-
-    cmd = commands.add_parser('order', help="Add the LEGO parts you need to the shopping bag"
-                                            " on LEGO's customer service platform.")
-    cmd.add_argument('--shop', '-s', default='en-us',
-                     choices=['nl-be', 'fr-be', 'cs-cz', 'da-dk', 'de-de', 'es-es', 'fr-fr',
-                              'it-it', 'es-ar', 'hu-hu', 'nl-nl', 'nb-no', 'pl-pl', 'fi-fi',
-                              'sv-se', 'en-gb', 'en-us', 'ru-ru', 'ko-kr', 'zh-cn', 'ja-jp'],
+    cmd.add_argument('--own', nargs='+', metavar='SET',
+                     help="Set numbers of the LEGO sets you own (instead of omitted_set)")
+    cmd.add_argument('--want', nargs='+', metavar='SET',
+                     help="Set numbers of the LEGO sets you want all pieces of"
+                          " (instead of omitted_set)")
+    cmd.add_argument('--datafile', '-f', default=COMBINED_LIST,
+                     help="The combined list data file. Default: {}".format(COMBINED_LIST))
+
+    # options of the order and batch commands
+    session = ArgumentParser(add_help=False)
+    session.add_argument('--browser', '-b', default='firefox', choices=['chrome', 'firefox'],
+                         help="Web browser that will be used to open the LEGO shop."
+                              " Default: firefox")
+    session.add_argument('--username', '-u', help="User name for your LEGO ID account")
+    session.add_argument('--password', '-p', help="Password for your LEGO ID account")
+    session.add_argument('--headless', action='store_true',
+                         help="Don't show the browser window. Use it with a logged-in session,"
+                              " so you can finalize your order later in a normal browser.")
+    session.add_argument('--profile',
+                         help="Browser profile directory to start with, e.g. one that is logged"
+                              " in already (only Chrome keeps changes to the profile)")
+    session.add_argument('--cookies',
+                         help="Cookie jar file: cookies are loaded from it on startup and saved"
+                              " to it after a successful login")
+    session.add_argument('--browser-info', action='store_true',
+                         help="Print the Selenium version and browser capabilities")
+    session.add_argument('--base-url', default='https://www.lego.com/',
+                         help="Base URL of the LEGO shop, e.g. of a local fakeshop.py for"
+                              " testing. Default: https://www.lego.com/")
+    session.add_argument('--trace',
+                         help="Write timing spans of all steps to this file, as a Chrome"
+                              " trace (chrome://tracing) if it ends with .json, as JSON lines"
+                              " otherwise")
+    session.add_argument('--workers', '-w', type=int, default=0,
+                         help="Number of headless browsers looking up the parts concurrently,"
+                              " when the shop doesn't list all elements of the set. Default: 0")
+    session.add_argument('--rate', type=float,
+                         help="Maximum number of part lookups per second of all --workers")
+    session.add_argument('--cache',
+                         help="File to remember which parts the shop has (and under which"
+                              " element ID) between orders, so known results aren't searched"
+                              " again")
+    session.add_argument('--cache-ttl', type=float, default=24,
+                         help="Hours to trust the results in the --cache file. Default: 24")
+    session.add_argument('--cache-size', type=int, default=10000,
+                         help="Maximum number of parts in the --cache file, the least recently"
+                              " used ones are dropped. Default: 10000")
+    session.add_argument('--fallback-sets', action='store_true',
+                         help="Look for the parts that aren't in the set in other sets of the"
+                              " combined list, visiting as few of them as possible")
+    session.add_argument('--batch-size', type=int, default=25,
+                         help="Number of found parts to add to the bag at once, when the shop"
+                              " lists all elements of the set (1 = one at a time). Default: 25")
+
+    shops = ['nl-be', 'fr-be', 'cs-cz', 'da-dk', 'de-de', 'es-es', 'fr-fr', 'it-it', 'es-ar',
+             'hu-hu', 'nl-nl', 'nb-no', 'pl-pl', 'fi-fi', 'sv-se', 'en-gb', 'en-us', 'ru-ru',
+             'ko-kr', 'zh-cn', 'ja-jp']
+
+    cmd = commands.add_parser('order', parents=[session],
+                              help="Add the LEGO parts you need to the shopping bag"
+                                   " on LEGO's customer service platform.")
+    cmd.add_argument('--shop', '-s', default='en-us', choices=shops,
                      help="<language-country> identifier of the LEGO shop (language and"
                           " geographic region) you want to use for ordering. Default: en-us")
-    cmd.add_argument('--browser', '-b', default='firefox', choices=['chrome', 'firefox'],
-                     help="Web browser that will be used to open the LEGO shop. Default: firefox")
-    cmd.add_argument('--username', '-u', help="User name for your LEGO ID account")
-    cmd.add_argument('--password', '-p', help="Password for your LEGO ID account")
     cmd.add_argument('--lego-set', '-l', default=SET_EDUCORE,
                      choices=[SET_EV3HOME, SET_EDUCORE, SET_EDUEXPA],
                      help="The LEGO set you did *not* buy, which you need the bricks from."
                           " 31313 = Mindstorms EV3, 45544 = Edu Core, 45560 = Edu Expansion."
                           " Default: 45544 (Edu Core)")
+    cmd.add_argument('--refresh-cache', action='store_true',
+                     help="Forget the cached results for the shop and set of this order")
+    cmd.add_argument('--reconcile', action='store_true',
+                     help="Read the shopping bag first and only add, adjust or remove the"
+                          " parts that differ from the order list, e.g. to continue an"
+                          " interrupted order")
+    cmd.add_argument('--journal',
+                     help="Write each processed part to this file right away, to --resume"
+                          " the order if it's interrupted")
+    cmd.add_argument('--resume', action='store_true',
+                     help="Continue the order in the --journal file, skipping the parts"
+                          " processed already")
     cmd.add_argument('order_list',
                      help="A list of LEGO part_number:quantity you want to buy, separated by"
-                          " comma signs. Example: 370526:4,370726:2,4107085:4,4107767:2")
+                          " comma signs. Example: 370526:4,370726:2,4107085:4,4107767:2"
+                          " Or a file with such a list (also one part per line), or - to read"
+                          " it from stdin, e.g. the output of the missing command")
+
+    cmd = commands.add_parser('compare', help="Check which LEGO parts of a list the shops of"
+                                              " several countries have, at once, and at what"
+                                              " price.")
+    cmd.add_argument('--shops', '-s', required=True, type=lambda value: value.split(','),
+                     help="<language-country> identifiers of the LEGO shops to compare,"
+                          " separated by comma signs, e.g. de-de,fr-fr,en-gb")
+    cmd.add_argument('--browser', '-b', default='firefox', choices=['chrome', 'firefox'],
+                     help="Web browser to check the shops with (headless). Default: firefox")
+    cmd.add_argument('--lego-set', '-l', default=SET_EDUCORE,
+                     choices=[SET_EV3HOME, SET_EDUCORE, SET_EDUEXPA],
+                     help="The LEGO set to look up the parts in. Default: 45544 (Edu Core)")
+    cmd.add_argument('--cookies',
+                     help="Cookie jar file to load cookies from, e.g. of the order command")
+    cmd.add_argument('--base-url', default='https://www.lego.com/',
+                     help="Base URL of the LEGO shops. Default: https://www.lego.com/")
+    cmd.add_argument('--output', '-o',
+                     help="Write the comparison (CSV) to this file instead of stdout")
+    cmd.add_argument('--workers', '-w', type=int, default=4,
+                     help="Number of shops to check at a time, each in a headless browser."
+                          " Default: 4")
+    cmd.add_argument('order_list',
+                     help="A list of LEGO part_number:quantity, separated by comma signs, or a"
+                          " file with such a list, or - to read it from stdin")
+
+    cmd = commands.add_parser('batch', parents=[session],
+                              help="Run a file of order jobs in one browser session, the jobs of"
+                                   " the same shop and set one after the other.")
+    cmd.add_argument('--stats',
+                     help="Write the statistics of each job to this file (JSON lines) instead"
+                          " of stdout")
+    cmd.add_argument('--aggregate', action='store_true',
+                     help="Order the parts of all jobs of the same shop and set at once,"
+                          " summing up the quantities of the same part")
+    cmd.add_argument('jobfile',
+                     help="Order jobs, one JSON object per line, e.g. {\"name\": \"robot 1\","
+                          " \"shop\": \"de-de\", \"lego_set\": \"45544\", \"order_list\":"
+                          " \"370526:4,370726:2\"}")
+
+    cmd = commands.add_parser('serve', help="Keep the data files and the browser of orders"
+                                            " loaded, and run the missing and order commands"
+                                            " of clients using --socket.")
+    cmd.add_argument('--datafile', '-f', default=COMBINED_LIST,
+                     help="The combined list data file to load up front."
+                          " Default: {}".format(COMBINED_LIST))
 
     # avoid intimidating the user ("error: ... required") with no arguments
     if len(sys.argv) == 1:
@@ -84,99 +226,309 @@ def main():
         parser.exit()
 
     args = parser.parse_args()
+    for shop in getattr(args, 'shops', None) or []:
+        if shop not in shops:
+            parser.error("unknown shop {!r} (choose from {})".format(shop, ', '.join(shops)))
     kwargs = vars(args).copy()
     kwargs.pop('command', None)
+    socket = kwargs.pop('socket', None)
+
+    if args.command == 'serve':
+        if not socket:
+            raise SystemExit("Specify the --socket to serve on.")
+        kwargs['socket'] = socket
+
+    elif socket and args.command in ('missing', 'order'):
+        import server
+
+        for name in PATH_ARGUMENTS:
+            if kwargs.get(name):
+                kwargs[name] = os.path.abspath(kwargs[name])
+        if kwargs.get('order_list') == '-':
+            kwargs['order_list'] = sys.stdin.read()
+        elif kwargs.get('order_list') and os.path.isfile(kwargs['order_list']):
+            kwargs['order_list'] = os.path.abspath(kwargs['order_list'])
+        raise SystemExit(server.request(socket, args.command, kwargs))
 
     function = globals()[args.command]
     function(**kwargs)
 
 
-def parse(datafiles):
+def parse(datafiles, output=None, jobs=1, sets=None, incremental=False, database=None):
     """
-    Parse LEGO inventory files and combine them into a single list.
+    Parse LEGO inventory files, or the inventories of some sets in full
+    dumps, and combine them into a single list, or store it in a part
+    database along with the new element IDs and the electric parts.
     """
-    part_list = {}
-    part_names = {}
-    part_designids = {}
-    part_imageurls = {}
-    NO_PARTS = [0 for a in range(len(datafiles))]
-
-    for file_count, name in enumerate(datafiles):
-        print('Reading file: %s' % name, file=sys.stderr)
-        with open(name) as f:
-            data_lines = f.readlines()[1:]
-            for line in data_lines:
-                line = line.strip()
-                try:
-                    (set_no, part_no, quantity, color, category, design_id,
-                     part_name, image_url, set_count) = line.split('\t')
-
-                    part_no, quantity = int(part_no), int(quantity)
-
-                    if part_no not in part_list.keys():
-                        part_list[part_no] = NO_PARTS.copy()
-                        part_names[part_no] = part_name
-                        part_designids[part_no] = design_id
-                        part_imageurls[part_no] = image_url
-
-                    part_list[part_no][file_count] = quantity
-                except ValueError as err:
-                    print('Ignoring error: %s (%s)' % (err, line),
-                          file=sys.stderr)
-
-    part_numbers = list(part_list.keys())
-    part_numbers.sort()
-
-    print('Part no.\tLego ID\t%s\tPart name\tImage' % '\t'.join(datafiles))
-    for part_no in part_numbers:
-        part_data = {
-            'partno': part_no,
-            'legoid': part_designids[part_no],
-            'counts': '\t'.join([str(a) for a in part_list[part_no]]),
-            'name': part_names[part_no],
-            'image': part_imageurls[part_no],
-        }
-        print('%(partno)s\t'
-              '%(legoid)s\t'
-              '%(counts)s\t'
-              '%(name)s\t'
-              '%(image)s' % part_data)
-
-
-def missing(omitted_set, datafile):
+    if sets and incremental:
+        raise SystemExit("Dumps of all sets can't be read incrementally.")
+    if not sets:
+        datafiles = inventory.expand_datafiles(datafiles)
+
+    state = None
+    if incremental:
+        if output is None and database is None:
+            raise SystemExit("Specify the --output file (or --database) to update incrementally.")
+        state = inventory.BuildState(output or database)
+
+    if not sets and state is None and database is None:
+        if output is None:
+            inventory.merge(datafiles, jobs=jobs)
+            return
+
+        with open(output, 'w') as f:
+            inventory.merge(datafiles, f, jobs=jobs)
+        return
+
+    if sets:
+        combined = inventory.extract(datafiles, sets)
+    elif state is not None:
+        # None if nothing changed since the output was written
+        combined = inventory.combine_incremental(datafiles, state, jobs=jobs)
+    else:
+        combined = inventory.combine(datafiles, jobs=jobs)
+
+    if database is not None:
+        part_database = inventory.PartDatabase(database)
+        if combined is not None:
+            part_database.write_combined_list(combined)
+        part_database.write_table(inventory.load_elementid_refresh, NEW_ELEMENT_IDS)
+        part_database.write_table(inventory.load_electric_parts, ELECTRIC_PARTS)
+        part_database.close()
+        print('Wrote database: %s' % database, file=sys.stderr)
+
+    if output is not None and combined is not None:
+        with open(output, 'w') as f:
+            combined.write(f)
+    elif output is None and database is None:
+        combined.write()
+
+    if state is not None:
+        state.save()
+
+
+def missing(omitted_set, datafile, own=None, want=None, matrix=None, database=None):
     """
-    Generate a list of LEGO parts missing in the remaining two LEGO sets.
+    Generate a list of LEGO parts missing in the remaining two LEGO sets,
+    or in general the parts missing in the sets you own to complete the
+    sets you want.
     """
-    order_list = []
-
-    with open(datafile) as f:
-        data_lines = f.readlines()[1:]
-        for line in data_lines:
-            (partno, legoid, count_home, count_core, count_expa, name, image) = line.split('\t')
-            difference = \
-                int(count_home) - int(count_core) if omitted_set == SET_EV3HOME else (
-                    int(count_core) - int(count_home) if omitted_set == SET_EDUCORE else (
-                        None  # undefined (will cause an error)
-                    )
-                )
-            if difference > 0:
-                order_list += ['{pn}:{qty}'.format(pn=partno, qty=difference)]
+    if omitted_set:
+        if own or want:
+            raise SystemExit("Specify either the omitted set or --own/--want, not both.")
+        want = [omitted_set]
+        own = [SET_EDUCORE if omitted_set == SET_EV3HOME else SET_EV3HOME]
+    elif not want:
+        raise SystemExit("Specify the omitted set or the sets you --want.")
+
+    if matrix is None:
+        matrix = inventory.InventoryMatrix.load(database or datafile, (own or []) + want)
+    order_list = ['{pn}:{qty}'.format(pn=part_no, qty=quantity)
+                  for part_no, quantity in matrix.missing(own or [], want)]
 
     print(','.join(order_list))
 
 
-def order(shop=None, browser=None, lego_set=None, order_list=None, username=None, password=None):
+def order(shop=None, browser=None, lego_set=None, order_list=None, username=None, password=None,
+          workers=0, rate=None, headless=False, profile=None, cookies=None, browser_info=False,
+          base_url='https://www.lego.com/', trace=None, cache=None, cache_ttl=24,
+          cache_size=10000, refresh_cache=False, reconcile=False, journal=None, resume=False,
+          batch_size=25, fallback_sets=False, database=None, replacement_part=None):
     """
-    Fill in LEGO parts to be ordered in LEGO's customer service shop.
+    Fill in LEGO parts to be ordered in LEGO's customer service shop,
+    with the browser of an earlier order's ``replacement_part`` if given.
     """
     import legoshop
 
-    order = legoshop.ReplacementPart(browser, shop)
-    order.set_new_element_id_datafile(
-        os.path.join(SCRIPT_PATH, 'raw-data', 'elementid-refresh.csv'))
-    order.set_electric_part_datafile(os.path.join(SCRIPT_PATH, 'raw-data', 'Electric-parts.csv'))
+    if resume and not journal:
+        raise SystemExit("Specify the --journal of the order to --resume.")
+
+    order = replacement_part or legoshop.ReplacementPart(browser, shop, headless)
+    order.lego_shop = shop
+    order.set_session(profile, cookies)
+    order.show_browser_info = browser_info
+    order.base_url = base_url
+    order.set_trace_file(trace)
+    order.set_availability_cache(cache, cache_ttl * 3600, cache_size)
+    if refresh_cache:
+        order.availability.invalidate(shop, lego_set)
+    order.set_new_element_id_datafile(database or NEW_ELEMENT_IDS)
+    order.set_electric_part_datafile(database or ELECTRIC_PARTS)
+    order.set_combined_list_datafile(database or COMBINED_LIST)
+    order.set_fallback_sets(fallback_sets)
     order.set_credentials(username, password)
-    order.process(lego_set, order_list)
+    order.set_lookup_workers(workers, rate)
+    order.set_batch_size(batch_size)
+    order.set_reconcile(reconcile)
+    order.set_journal(journal, resume)
+
+    if order_list == '-':
+        order.process(lego_set, sys.stdin)
+    elif os.path.isfile(order_list):
+        with open(order_list) as f:
+            order.process(lego_set, f)
+    else:
+        order.process(lego_set, order_list)
+
+
+def compare(shops, browser, lego_set, order_list, cookies=None, base_url='https://www.lego.com/',
+            output=None, workers=4, database=None):
+    """
+    Compare which parts of an order list the shops of several countries
+    have, writing a CSV matrix of their answers and prices, the shop that
+    can supply the most parts first.
+    """
+    import legoshop
+
+    if workers < 1:
+        raise SystemExit("Specify --workers 1 or more.")
+
+    if order_list == '-':
+        order_list = sys.stdin
+    elif os.path.isfile(order_list):
+        with open(order_list) as f:
+            order_list = f.readlines()
+    else:
+        order_list = [order_list]
+
+    quantities = {}
+    for part_no, quantity in legoshop.read_order_list(order_list):
+        quantities[part_no] = quantities.get(part_no, 0) + quantity
+
+    shops = list(dict.fromkeys(shops))
+    results = legoshop.check_shops(browser, shops, lego_set, list(quantities), base_url, cookies,
+                                   database or NEW_ELEMENT_IDS, database or ELECTRIC_PARTS,
+                                   workers)
+
+    checked = []
+    for shop in shops:
+        if isinstance(results[shop], str):
+            print("!!! Could not check shop {shop}: {error}".format(
+                shop=shop, error=results[shop]), file=sys.stderr)
+        else:
+            checked.append(shop)
+
+    def supplied(shop):
+        return sum(outcome == 'found' for outcome, _, _ in results[shop].values())
+
+    checked.sort(key=supplied, reverse=True)
+
+    rows = [['Part no.', 'Quantity'] +
+            [column.format(shop) for shop in checked
+             for column in ('{}', '{} element ID', '{} price')]]
+    for part_no, quantity in quantities.items():
+        row = [part_no, quantity]
+        for shop in checked:
+            outcome, element_id, price = results[shop][part_no]
+            row += [outcome, element_id or '', price or '']
+        rows.append(row)
+
+    for shop in checked:
+        print("{shop}: {count} of {total} parts available".format(
+            shop=shop, count=supplied(shop), total=len(quantities)), file=sys.stderr)
+
+    if output is None:
+        csv.writer(sys.stdout).writerows(rows)
+        return
+
+    with open(output, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+
+def batch(jobfile, stats=None, aggregate=False, **options):
+    """
+    Fill in the order lists of a file of jobs in one browser session,
+    writing the statistics of each job.
+    """
+    import legoshop
+
+    jobs = legoshop.read_order_jobs(jobfile)
+    replacement_part = legoshop.ReplacementPart(options['browser'], None, options['headless'])
+    job_stats = []
+
+    # jobs of the same shop and set in a row, so that the set is selected once
+    by_shop_and_set = operator.itemgetter('shop', 'lego_set')
+    for (shop, lego_set), group in itertools.groupby(sorted(jobs, key=by_shop_and_set),
+                                                     by_shop_and_set):
+        group = list(group)
+        if aggregate:
+            runs = [(group, legoshop.merge_order_lists(job['order_list'] for job in group))]
+        else:
+            runs = [([job], job['order_list']) for job in group]
+
+        for run_jobs, order_list in runs:
+            print()
+            print("*** {names}: shop {shop}, set {lego_set}".format(
+                names=', '.join(job['name'] for job in run_jobs), shop=shop, lego_set=lego_set))
+
+            order(shop=shop, lego_set=lego_set, order_list=order_list,
+                  replacement_part=replacement_part, **options)
+
+            for job in run_jobs:
+                if aggregate:
+                    statistics = replacement_part.statistics_for(job['order_list'])
+                else:
+                    statistics = dict(replacement_part.part_stats_counter)
+                job_stats.append(dict(job=job['name'], shop=shop, lego_set=lego_set,
+                                      **statistics))
+
+    lines = ''.join(json.dumps(statistics) + '\n' for statistics in job_stats)
+    if stats is None:
+        print()
+        print(lines, end='')
+    else:
+        with open(stats, 'w') as f:
+            f.write(lines)
+
+
+def serve(socket, datafile, database=None):
+    """
+    Run the missing and order commands of clients in this process, which
+    keeps the data files, and a browser per browser setup, loaded.  A data
+    file is loaded again when it changed since, and a client's --database
+    takes the place of the server's.
+    """
+    import legoshop
+    import server
+
+    server_database = database
+    loaded = {}
+
+    def load(loader, filename):
+        try:
+            stat = os.stat(filename)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+
+        if signature is None or loaded.get((loader, filename), (None,))[0] != signature:
+            loaded[(loader, filename)] = (signature, loader(filename))
+        return loaded[(loader, filename)][1]
+
+    load(inventory.InventoryMatrix.load, database or datafile)
+    replacement_parts = {}
+
+    def serve_missing(datafile, database=None, **kwargs):
+        datafile = database or server_database or datafile
+        missing(datafile=datafile, matrix=load(inventory.InventoryMatrix.load, datafile),
+                **kwargs)
+
+    def serve_order(browser, headless, profile, cookies, base_url, database=None, **kwargs):
+        database = database or server_database
+        setup = (browser, headless, profile, cookies, base_url)
+        if setup not in replacement_parts:
+            replacement_parts[setup] = legoshop.ReplacementPart(browser, kwargs['shop'], headless)
+
+        replacement_part = replacement_parts[setup]
+        replacement_part.updated_parts = load(legoshop.UpdatedPartMapping,
+                                              database or NEW_ELEMENT_IDS)
+        replacement_part.electric_parts = load(legoshop.MindstormsElectricPart,
+                                               database or ELECTRIC_PARTS)
+
+        order(browser=browser, headless=headless, profile=profile, cookies=cookies,
+              base_url=base_url, database=database, replacement_part=replacement_part, **kwargs)
+
+    server.CommandServer(socket, {'missing': serve_missing, 'order': serve_order}).serve()
 
 
 if __name__ == "__main__":
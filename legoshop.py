@@ -19,23 +19,42 @@
 #
 """
 
+import json
+import os
 import os.path
+import re
 import sys
 import textwrap
 
-from time import sleep
+import threading
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Empty, Queue
+from time import monotonic, sleep, time
 from selenium import webdriver
 
 from selenium.common.exceptions import (
     NoSuchElementException, TimeoutException, WebDriverException
 )
-from selenium.webdriver import Chrome, Firefox, ChromeOptions
+from selenium.webdriver import Chrome, Firefox, ChromeOptions, FirefoxProfile
+from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.select import Select
 from selenium.webdriver.support.wait import WebDriverWait
 
+import inventory
+
+
+def empty_table():
+    """
+    Compiled table without any rows
+    """
+    return inventory.CompiledTable(inventory.pack_compiled_table([], [], []))
+
 
 class UpdatedPartMapping:
     """
@@ -44,10 +63,16 @@ class UpdatedPartMapping:
 
     def __init__(self, datafile=None):
         """
-        Load list of new element IDs
+        Load list of new element IDs, and how often each of them was found
+        in past orders (``<datafile>.found.json``)
         """
 
-        self.map = {}
+        self.table = empty_table()
+        self.found_file = None
+        self.found_counts = {}
+        self.part_lists = {}
+        self.originals = None
+        self.lock = threading.Lock()
 
         try:
             if not os.path.isfile(datafile):
@@ -57,16 +82,14 @@ class UpdatedPartMapping:
             print("Datafile for New Element ID not set")
             return
 
-        with open(datafile) as file_handler:
-            data_lines = file_handler.readlines()[1:]
-            for line in data_lines:
-                line = line.strip()
-                eid_origin, eid_chain, eid_comment = line.split(';')
-                # list:  convert each new element id of eid_chain as number
-                self.map[int(eid_origin)] = {
-                    'list': list(map(int, eid_chain.split(","))),
-                    'comment': eid_comment
-                }
+        self.table = inventory.compiled_table(datafile, inventory.load_elementid_refresh)
+
+        self.found_file = datafile + '.found.json'
+        try:
+            with open(self.found_file) as f:
+                self.found_counts = {int(part_no): count for part_no, count in json.load(f).items()}
+        except (OSError, ValueError):
+            pass
 
     def partno_exists(self, original_part_no):
         """
@@ -74,27 +97,71 @@ class UpdatedPartMapping:
 
         return boolean
         """
-        original_part_no = int(original_part_no)
-        if original_part_no in self.map.keys():
-            return True
-        return False
+        return self.table.find(int(original_part_no)) is not None
 
     def get_part_list(self, original_part_no):
         """
-        Get list of updated ID(s) for wanted part ID
+        Get list of updated ID(s) for wanted part ID, including the ones
+        they were replaced by in turn, the most often found ones first
 
-        return hash
+        return list
         """
+        original_part_no = int(original_part_no)
+
+        new_part_no_list = self.part_lists.get(original_part_no)
+        if new_part_no_list is not None:
+            return new_part_no_list
 
         new_part_no_list = []
 
-        original_part_no = int(original_part_no)
+        row = self.table.find(original_part_no)
 
-        if self.partno_exists(original_part_no):
-            new_part_no_list = self.map[original_part_no]['list']
+        if row is not None:
+            new_part_no_list = inventory.split_part_nos(self.table.string(2, row))
+            # stable sort: never found ones keep the order of the chain
+            new_part_no_list.sort(key=lambda part_no: -self.found_counts.get(part_no, 0))
 
+        self.part_lists[original_part_no] = new_part_no_list
         return new_part_no_list
 
+    def get_original_part_nos(self, new_part_no):
+        """
+        Get the part IDs a new part ID replaces, directly or not
+
+        return list
+        """
+        if isinstance(self.table, inventory.DatabaseTable):
+            return self.table.originals(int(new_part_no))
+
+        if self.originals is None:
+            originals = {}
+            original_part_nos = self.table.ints(0)
+            for row in range(len(self.table)):
+                for part_no in inventory.split_part_nos(self.table.string(2, row)):
+                    originals.setdefault(part_no, []).append(original_part_nos[row])
+            self.originals = originals
+
+        return self.originals.get(int(new_part_no), [])
+
+    def record_found(self, part_no):
+        """
+        Count a new part ID found in the shop, to try it early next time
+        """
+        with self.lock:
+            self.found_counts[part_no] = self.found_counts.get(part_no, 0) + 1
+
+    def save_found_counts(self):
+        """
+        Write how often each new part ID was found next to the datafile
+        """
+        if self.found_file is None or not self.found_counts:
+            return
+
+        with self.lock:
+            counts = {str(part_no): count for part_no, count in sorted(self.found_counts.items())}
+        with open(self.found_file, 'w') as f:
+            json.dump(counts, f, indent=1)
+
     def get_part_comment(self, original_part_no):
         """
         Get comment about a part ID
@@ -102,14 +169,274 @@ class UpdatedPartMapping:
         return string
         """
 
-        original_part_no = int(original_part_no)
+        row = self.table.find(int(original_part_no))
 
-        if self.partno_exists(original_part_no):
-            return self.map[original_part_no]['comment']
+        if row is not None:
+            return self.table.string(1, row)
 
         return "<no comment set>"
 
 
+class AvailabilityCache:
+    """
+    What the shop said about the parts of a set in earlier orders: the
+    element ID found for a part, its status, and whether it could be added
+    to the bag.  Entries are keyed by shop, set and part, expire after
+    ``ttl`` seconds, and the least recently used ones are dropped beyond
+    ``max_entries``.  Without a file nothing is kept between orders.
+    """
+
+    def __init__(self, filename=None, ttl=24 * 3600, max_entries=10000):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        if not filename:
+            return
+
+        try:
+            with open(filename) as file_handler:
+                self.entries.update((key, tuple(entry)) for key, entry in json.load(file_handler))
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            print("!!! Ignoring the broken availability cache {}".format(filename))
+
+    @staticmethod
+    def _key(shop, lego_set, part_no):
+        return '{}/{}/{}'.format(shop, lego_set, part_no)
+
+    def get(self, shop, lego_set, original_part_no):
+        """
+        Look up a part's last known availability
+
+        return (part_no, status, in_stock) or None if unknown or expired
+        """
+        key = self._key(shop, lego_set, original_part_no)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[3] + self.ttl < time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[:3]
+
+    def put(self, shop, lego_set, original_part_no, part_no, status, in_stock=None):
+        """
+        Remember a part's availability
+        """
+        key = self._key(shop, lego_set, original_part_no)
+        with self.lock:
+            self.entries[key] = (part_no, status, in_stock, time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, shop=None, lego_set=None):
+        """
+        Forget all parts, or those of a shop and set
+        """
+        prefix = self._key(shop, lego_set, '') if shop else ''
+        with self.lock:
+            for key in [key for key in self.entries if key.startswith(prefix)]:
+                del self.entries[key]
+
+    def save(self):
+        """
+        Write the unexpired entries to the cache file, if we have one
+        """
+        if not self.filename:
+            return
+
+        expired = time() - self.ttl
+        with self.lock:
+            entries = [(key, entry) for key, entry in self.entries.items() if entry[3] >= expired]
+
+        temp_file = self.filename + '.tmp'
+        with open(temp_file, 'w') as file_handler:
+            json.dump(entries, file_handler)
+        os.replace(temp_file, self.filename)
+
+
+class OrderJournal:
+    """
+    Append-only journal of the processed entries of an order list, one
+    JSON object per line, each on disk before the next entry is processed.
+    Replaying it tells what an interrupted order did already.  A part is
+    journaled as ``pending`` before it's added to the bag, so that a crash
+    while adding it is reconciled against the bag instead of adding it twice.
+    """
+
+    def __init__(self, filename, shop, lego_set, resume=False):
+        self.filename = filename
+        self.entries = {}
+
+        if resume:
+            self.entries = self._replay(filename, shop, lego_set)
+
+        self.file = open(filename, 'a' if resume and os.path.isfile(filename) else 'w')
+        if not self.entries and self.file.tell() == 0:
+            self._write({'shop': shop, 'lego_set': lego_set})
+
+    @staticmethod
+    def _replay(filename, shop, lego_set):
+        entries = {}
+        try:
+            with open(filename) as file_handler:
+                lines = file_handler.readlines()
+        except FileNotFoundError:
+            print("* No order journal {} to resume, let's start from the beginning."
+                  .format(filename))
+            return entries
+
+        if lines and not lines[-1].endswith('\n'):
+            # the last line was cut short by a crash, append after the one before
+            lines.pop()
+            with open(filename, 'r+') as file_handler:
+                file_handler.truncate(sum(len(line.encode('utf-8')) for line in lines))
+
+        for number, line in enumerate(lines):
+            record = json.loads(line)
+
+            if number == 0:
+                if (record.get('shop'), record.get('lego_set')) != (shop, lego_set):
+                    raise SystemExit("The order journal {} is for set {} in shop {}.".format(
+                        filename, record.get('lego_set'), record.get('shop')))
+                continue
+
+            entries[record['part_no']] = record
+
+        pending = sum(1 for entry in entries.values() if entry['outcome'] == 'pending')
+        print("* Resuming the order, {count} entries are done already, {pending} were"
+              " being added to the bag.".format(count=len(entries) - pending, pending=pending))
+        return entries
+
+    def _write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def get(self, original_part_no):
+        """
+        Get the journal entry of a processed part
+
+        return dict or None
+        """
+        return self.entries.get(original_part_no)
+
+    def pending(self):
+        """
+        Get the element IDs of the parts interrupted while being added to the bag
+
+        return set of int
+        """
+        return {entry['element_id'] for entry in self.entries.values()
+                if entry['outcome'] == 'pending'}
+
+    def record(self, original_part_no, part_no, outcome, quantity=None):
+        """
+        Write down the outcome (a statistics counter name) of a processed part
+        """
+        entry = {'part_no': original_part_no, 'element_id': part_no,
+                 'outcome': outcome, 'quantity': quantity}
+        self._write(entry)
+        self.entries[original_part_no] = entry
+
+    def close(self):
+        self.file.close()
+
+
+def read_order_jobs(filename):
+    """
+    Read a file of order jobs, one JSON object per line with the keys
+    ``lego_set``, ``order_list``, and optionally ``shop`` and ``name``
+
+    return list of dict
+    """
+    jobs = []
+    with open(filename) as file_handler:
+        for number, line in enumerate(file_handler, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                job = {
+                    'name': str(job.get('name', 'job {}'.format(len(jobs) + 1))),
+                    'shop': job.get('shop', 'en-us'),
+                    'lego_set': str(job['lego_set']),
+                    'order_list': job['order_list'],
+                }
+            except (ValueError, KeyError, AttributeError):
+                raise SystemExit("{file}:{line}: not a job with a lego_set and an order_list"
+                                 .format(file=filename, line=number))
+            jobs.append(job)
+    return jobs
+
+
+def read_order_list(lines):
+    """
+    Read an order list line by line, e.g. from a file: part_number:quantity
+    entries separated by comma signs, white space or line breaks
+
+    yield (part number, quantity)
+    """
+    for line in lines:
+        for entry in line.replace(',', ' ').split():
+            part_no, _, quantity = entry.partition(':')
+            try:
+                yield int(part_no), int(quantity or 1)
+            except ValueError:
+                raise SystemExit("Not a part_number:quantity entry: {!r}".format(entry))
+
+
+def merge_order_lists(order_lists):
+    """
+    Merge order lists into one, summing up the quantities of the same part
+
+    return string, part_number:quantity separated by comma signs
+    """
+    quantities = {}
+    for part_no, quantity in read_order_list(order_lists):
+        quantities[part_no] = quantities.get(part_no, 0) + quantity
+
+    return ','.join('{pn}:{qty}'.format(pn=part_no, qty=quantity)
+                    for part_no, quantity in quantities.items())
+
+
+def check_shops(browser_name, shops, lego_set, part_numbers, base_url="https://www.lego.com/",
+                cookie_jar=None, new_element_id_datafile=None, electric_part_datafile=None,
+                workers=None):
+    """
+    Look up parts in a set in several shops at once, each in its own
+    headless browser, at most ``workers`` (default: all) of them at a time
+
+    return dict, shop -> ReplacementPart.check_availability() result, or
+    the error message if the shop couldn't be checked
+    """
+    updated_parts = UpdatedPartMapping(new_element_id_datafile)
+    electric_parts = MindstormsElectricPart(electric_part_datafile)
+
+    def check(shop):
+        checker = ReplacementPart(browser_name, shop, headless=True)
+        checker.base_url = base_url
+        checker.updated_parts = updated_parts
+        checker.electric_parts = electric_parts
+        checker.set_session(cookie_jar=cookie_jar)
+        try:
+            return checker.check_availability(lego_set, part_numbers)
+        except WebDriverException as error:
+            return "{name}: {message}".format(name=type(error).__name__, message=error.msg)
+        finally:
+            checker.close()
+
+    with ThreadPoolExecutor(max_workers=min(workers or len(shops), len(shops))) as executor:
+        return dict(zip(shops, executor.map(check, shops)))
+
+
 class MindstormsElectricPart:
     """
     Manage inventory about Mindstorms electric parts
@@ -120,7 +447,7 @@ class MindstormsElectricPart:
         Load list of electric part ID
         """
 
-        self.map = {}
+        self.table = empty_table()
 
         try:
             if not os.path.isfile(datafile):
@@ -130,11 +457,7 @@ class MindstormsElectricPart:
             print("Datafile for Electric Parts not set")
             return
 
-        with open(datafile) as file_handler:
-            data_lines = file_handler.readlines()[1:]
-            for line in data_lines:
-                partno, dummy_legoid, legoshop_set = line.split('\t')
-                self.map[int(partno)] = int(legoshop_set)
+        self.table = inventory.compiled_table(datafile, inventory.load_electric_parts)
 
     def partno_exists(self, part_no):
         """
@@ -142,11 +465,7 @@ class MindstormsElectricPart:
 
         return boolean
         """
-        part_no = int(part_no)
-
-        if part_no in self.map.keys():
-            return True
-        return False
+        return self.table.find(int(part_no)) is not None
 
     def get_partno_standalone_link(self, part_no):
         """
@@ -154,23 +473,257 @@ class MindstormsElectricPart:
         """
 
         part_no = int(part_no)
+        row = self.table.find(part_no)
 
-        if self.partno_exists(part_no):
-            lego_shop_set = self.map[part_no]
+        if row is not None:
+            lego_shop_set = self.table.integer(1, row)
             print("#{part_no}: standalone set URL "
                   "https://shop.lego.com/en-US/search/{legoshop_set}"
                   .format(part_no=part_no,
                           legoshop_set=lego_shop_set))
 
 
+def select_quantity(amount_select, quantity):
+    """
+    Select a quantity in a Select by its visible text, or the largest one
+    offered if it's more than the shop sells at once (e.g. of parts merged
+    from several lines of the order list)
+
+    return string, the quantity selected
+    """
+    try:
+        amount_select.select_by_visible_text(quantity)
+    except NoSuchElementException:
+        offered = [option.text.strip() for option in amount_select.options
+                   if option.text.strip().isdigit()]
+        if offered and int(quantity) > max(map(int, offered)):
+            amount_select.select_by_visible_text(max(offered, key=int))
+    return amount_select.first_selected_option.text
+
+
+def percentile(values, percent):
+    """
+    Nearest-rank percentile of a list of numbers
+    """
+    values = sorted(values)
+    if not values:
+        return 0
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+# record DOM mutations of the search results from now on: the container of
+# the .element-details items, the whole page until there are results
+ARM_MUTATION_SCRIPT = """
+window.legoshopMutation = {count: 0, last: 0};
+if (window.legoshopObserver) {
+    window.legoshopObserver.disconnect();
+}
+window.legoshopObserver = new MutationObserver(function () {
+    window.legoshopMutation.count++;
+    window.legoshopMutation.last = Date.now();
+});
+var details = document.querySelector('.element-details');
+var results = details && details.parentElement.parentElement;
+window.legoshopObserver.observe(results || document.body,
+                                {childList: true, subtree: true, characterData: true});
+"""
+
+# true once the DOM changed and has been quiet for a moment
+DOM_SETTLED_SCRIPT = """
+var mutation = window.legoshopMutation;
+return mutation && mutation.count > 0 && Date.now() - mutation.last > arguments[0];
+"""
+
+# true once only the searched element ID (arguments[0]) is listed, or the
+# results changed and have been quiet for a moment (arguments[1] ms)
+SEARCH_DONE_SCRIPT = r"""
+var details = document.querySelectorAll('.element-details');
+var pattern = new RegExp('\\b' + arguments[0] + '\\b');
+if (details.length && Array.prototype.every.call(details, function (item) {
+    return pattern.test(item.textContent);
+})) {
+    return true;
+}
+var mutation = window.legoshopMutation;
+return mutation && mutation.count > 0 && Date.now() - mutation.last > arguments[1];
+"""
+
+
+class AdaptiveWait:
+    """
+    Wait for conditions in the browser instead of sleeping a fixed time.
+
+    Latencies are recorded per step.  Conditions that may legitimately
+    never become true (e.g. a search that doesn't change the results)
+    give up after a timeout derived from the latencies observed so far.
+    A timeout counts as a latency too, so the timeout grows again when a
+    step gets slower, unless the condition wasn't expected to come true.
+    """
+
+    def __init__(self, browser, timeout=5, minimum=.5, factor=3, history=100):
+        self.browser = browser
+        self.timeout = timeout
+        self.minimum = minimum
+        self.factor = factor
+        self.history = history
+
+        self.latencies = {}
+        self.timeouts = {}
+        self.saved = {}
+
+    def timeout_for(self, step):
+        """
+        Timeout for a step: a multiple of its 95th latency percentile,
+        the full timeout until enough latencies have been observed
+        """
+        latencies = self.latencies.get(step, ())
+        if len(latencies) < 5:
+            return self.timeout
+        return min(self.timeout, max(self.minimum, self.factor * percentile(latencies, 95)))
+
+    def arm_dom_mutation(self):
+        """
+        Start recording DOM mutations, call before triggering a page update
+        """
+        self.browser.execute_script(ARM_MUTATION_SCRIPT)
+
+    @staticmethod
+    def dom_settled(quiet=.1):
+        """
+        Condition: the DOM changed since arm_dom_mutation() and has been
+        quiet for ``quiet`` seconds
+        """
+        return lambda driver: driver.execute_script(DOM_SETTLED_SCRIPT, quiet * 1000)
+
+    @staticmethod
+    def search_done(part_no, quiet=.1):
+        """
+        Condition: the search results list only ``part_no``, or they changed
+        since arm_dom_mutation() and have been quiet for ``quiet`` seconds
+        """
+        return lambda driver: driver.execute_script(SEARCH_DONE_SCRIPT, part_no, quiet * 1000)
+
+    def until(self, step, condition, fixed_sleep=0, required=True, expected=True,
+              maximum=None):
+        """
+        Wait until condition returns a true value and return it.
+
+        On timeout a required condition raises TimeoutException, any other
+        one returns None.  ``fixed_sleep`` is the time we used to sleep
+        instead, to account for the time saved.  The timeout of a condition
+        not ``expected`` to come true isn't recorded as a latency, and
+        ``maximum`` caps the timeout of one that isn't required.
+        """
+        timeout = self.timeout if required else self.timeout_for(step)
+        if maximum is not None and not required:
+            timeout = min(timeout, maximum)
+        start = monotonic()
+        try:
+            result = WebDriverWait(self.browser, timeout, poll_frequency=.05).until(condition)
+        except TimeoutException:
+            result = None
+            self.timeouts[step] = self.timeouts.get(step, 0) + 1
+            if required:
+                raise
+        finally:
+            elapsed = monotonic() - start
+            self.saved[step] = self.saved.get(step, 0) + fixed_sleep - elapsed
+
+        if result or expected:
+            self.latencies.setdefault(step, deque(maxlen=self.history)).append(elapsed)
+        return result
+
+    def report(self):
+        """
+        Print latencies, timeouts and time saved per step
+        """
+        print("Waiting times:")
+        for step in sorted(self.saved):
+            latencies = self.latencies.get(step, ())
+            print("- {step}: {count} waits, {timeouts} timed out, p50 {p50:.2f}s, p95 {p95:.2f}s,"
+                  " timeout {timeout:.2f}s, {saved:+.1f}s saved".format(
+                      step=step, count=len(latencies), timeouts=self.timeouts.get(step, 0),
+                      p50=percentile(latencies, 50), p95=percentile(latencies, 95),
+                      timeout=self.timeout_for(step), saved=self.saved[step]))
+        print("- Total: {saved:+.1f}s saved compared to fixed sleeps".format(
+            saved=sum(self.saved.values())))
+
+
+class Tracer:
+    """
+    Record timing spans, to find out where the time of an order goes.
+
+    Spans are written as JSON lines, or as a Chrome trace file (``.json``)
+    that chrome://tracing or Perfetto show as a timeline.
+    """
+
+    def __init__(self):
+        self.origin = monotonic()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name, category='order', **args):
+        """
+        Time the code in a with block
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.spans.append({
+                'name': name,
+                'cat': category,
+                'ts': round((start - self.origin) * 1e6),
+                'dur': round((monotonic() - start) * 1e6),
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def durations(self, category=None):
+        """
+        Durations in seconds per span name, in order of first occurrence
+
+        return dict
+        """
+        durations = {}
+        for span in self.spans:
+            if category is None or span['cat'] == category:
+                durations.setdefault(span['name'], []).append(span['dur'] / 1e6)
+        return durations
+
+    def summary(self):
+        """
+        Print count, latency percentiles and total time per span name
+        """
+        print("Timing:")
+        for name, durations in self.durations().items():
+            print("- {name}: {count}x, p50 {p50:.2f}s, p95 {p95:.2f}s, total {total:.1f}s".format(
+                name=name, count=len(durations), p50=percentile(durations, 50),
+                p95=percentile(durations, 95), total=sum(durations)))
+
+    def write(self, filename):
+        """
+        Write all spans to a Chrome trace file (*.json) or as JSON lines
+        """
+        with open(filename, 'w') as file_handler:
+            if filename.endswith('.json'):
+                events = [dict(span, ph='X', pid=os.getpid()) for span in self.spans]
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file_handler)
+            else:
+                for span in self.spans:
+                    file_handler.write(json.dumps(span) + '\n')
+
+
 class LegoShopBase:
     """
     Simple acces to Lego website: manage cookie acceptance + authentication
     """
 
-    def __init__(self, browser_name=None, shop=None):
+    def __init__(self, browser_name=None, shop=None, headless=False):
         self.browser_name = browser_name
         self.lego_shop = shop
+        self.headless = headless
 
         # Lego's credentials
         self.username = ""
@@ -179,9 +732,19 @@ class LegoShopBase:
         # future objects for selenium
         self.browser = None
         self.wait = None
+        self.adaptive_wait = None
 
+        self.base_url = "https://www.lego.com/"
         self.shop_url = ""
 
+        # warm start: browser profile directory and saved cookies
+        self.profile = None
+        self.cookie_jar = None
+        self.show_browser_info = False
+
+        # timing spans, startup steps have the 'startup' category
+        self.tracer = Tracer()
+
     def set_credentials(self, username, password):
         """
         Set username/password for Lego shop Login
@@ -189,24 +752,110 @@ class LegoShopBase:
         self.username = username
         self.password = password
 
+    def set_session(self, profile=None, cookie_jar=None):
+        """
+        Set browser profile directory and cookie jar file to reuse sessions
+        """
+        self.profile = profile
+        self.cookie_jar = cookie_jar
+
+    def _timed(self, step, function, *args):
+        """
+        Call a startup step and record its duration
+        """
+        with self.tracer.span(step, 'startup'):
+            return function(*args)
+
+    def print_startup_times(self):
+        """
+        Print how long each startup step took
+        """
+        print("Startup times:")
+        startup_times = self.tracer.durations('startup')
+        for step, seconds in startup_times.items():
+            print("- {step}: {seconds:.2f}s".format(step=step, seconds=sum(seconds)))
+        print("- Total: {seconds:.2f}s".format(
+            seconds=sum(map(sum, startup_times.values()))))
+
     def _init_browser(self, browser, url_path=""):
         """
         Open browser with LEGO shop URL (index page if path not set)
         """
-        self.shop_url = "https://www.lego.com/%s" % url_path
+        self.shop_url = self.base_url + url_path
 
-        self._load_driver(browser)
+        self._timed('load driver', self._load_driver, browser)
 
         # Selenium can't find some elements otherwise
-        self.browser.maximize_window()
+        if self.headless:
+            self.browser.set_window_size(1920, 1080)
+        else:
+            self._timed('maximize window', self.browser.maximize_window)
 
-        self.browser.get(self.shop_url)
+        self._timed('load page', self.browser.get, self.shop_url)
 
         # will wait to 5 sec for and ExpectedCondition success,
         # otherwise exception TimeoutException
         self.wait = WebDriverWait(self.browser, 5)
+        self.adaptive_wait = AdaptiveWait(self.browser, 5)
+
+        if self.show_browser_info:
+            self.browser_info()
+
+    def _restore_session(self, ready_locator):
+        """
+        Load saved cookies, and tell if they (or the browser profile) give
+        us a session where ready_locator is clickable right away, and
+        we're logged in if we have credentials
+
+        return boolean
+        """
+        if not (self.profile or self.cookie_jar):
+            return False
+
+        if self.cookie_jar and os.path.isfile(self.cookie_jar):
+            with open(self.cookie_jar) as file_handler:
+                cookies = json.load(file_handler)
+            for cookie in cookies:
+                if 'expiry' in cookie:
+                    cookie['expiry'] = int(cookie['expiry'])
+                try:
+                    self.browser.add_cookie(cookie)
+                except WebDriverException:
+                    pass
+            self.browser.get(self.shop_url)
+
+        return self._session_ready(ready_locator)
+
+    def _session_ready(self, ready_locator):
+        """
+        Tell if ready_locator is clickable right away, and we're logged in
+        if we have credentials
+
+        return boolean
+        """
+        quick_wait = WebDriverWait(self.browser, 2)
+        try:
+            quick_wait.until(EC.element_to_be_clickable(ready_locator))
+            if self.username and self.password:
+                quick_wait.until(EC.presence_of_element_located(
+                    (By.CSS_SELECTOR, ".legoid-box .links > a[data-uitest='logout-link']")))
+        except TimeoutException:
+            return False
+        return True
+
+    def _save_session(self):
+        """
+        Save the browser's cookies to the cookie jar file, if we have one
+        """
+        if not self.cookie_jar:
+            return
 
-        self.browser_info()
+        # session cookies are as good as a password: owner-only access
+        temp_file = self.cookie_jar + '.tmp'
+        descriptor = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(descriptor, 'w') as file_handler:
+            json.dump(self.browser.get_cookies(), file_handler)
+        os.replace(temp_file, self.cookie_jar)
 
     def _load_driver(self, browser):
         """
@@ -241,15 +890,25 @@ class LegoShopBase:
             # at the end without the "quit()" method!
             # Here is a fix to detach Chrome from python.
             opts = ChromeOptions()
-            if webdriver.__version__ > '2.48.0':
+            if self.headless:
+                opts.add_argument('--headless')
+            elif webdriver.__version__ > '2.48.0':
                 print("* Apply experimental detach option for Chrome")
                 opts.add_experimental_option("detach", True)
+            if self.profile:
+                opts.add_argument('--user-data-dir=%s' % self.profile)
+        else:
+            opts = FirefoxOptions()
+            if self.headless:
+                opts.add_argument('-headless')
 
         try:
             if browser == 'chrome':
                 self.browser = Chrome(chrome_options=opts)
             else:
-                self.browser = Firefox()
+                # Firefox uses a copy of the profile, changes aren't kept
+                profile = FirefoxProfile(self.profile) if self.profile else None
+                self.browser = Firefox(firefox_profile=profile, firefox_options=opts)
         except WebDriverException as err:
             message = textwrap.dedent("""\
                 There was a problem when loading the driver for your Web browser:
@@ -261,6 +920,43 @@ class LegoShopBase:
                 )
             raise SystemExit(message)
 
+    def is_healthy(self):
+        """
+        Check that the browser still responds and shows the element search
+
+        return boolean
+        """
+        try:
+            self.browser.find_element_by_id('element-filter')
+            return True
+        except WebDriverException:
+            return False
+
+    def is_alive(self):
+        """
+        Check that we have a browser and it still responds
+
+        return boolean
+        """
+        if self.browser is None:
+            return False
+        try:
+            self.browser.current_url
+            return True
+        except WebDriverException:
+            return False
+
+    def close(self):
+        """
+        Quit the browser, ignoring errors of a browser that already died
+        """
+        if self.browser is None:
+            return
+        try:
+            self.browser.quit()
+        except WebDriverException:
+            pass
+
     def browser_info(self):
         """
         Print information about browser instance
@@ -356,60 +1052,329 @@ class LegoShopBase:
             return True
 
 
-class ReplacementPart(LegoShopBase):
-    """
-    Add a list of LEGO parts and their quantity to the 'Shopping Bag' of LEGO's
-    customer service platform.  A browser window will be opened, you'll be able
-    to watch the browser do what you would normally do by hand, and execution
-    will stop after all pieces have been added, so you can review and finalize
-    your order.  (This is just to help you save time on entering 60+ pieces
-    manually.  Nothing is ordered on your behalf!)
-    """
-
-    def __init__(self, browser_name=None, shop=None):
-        super().__init__(browser_name, shop)
+# price shown next to an element's details, if any
+PRICE_FUNCTION = r"""
+function elementPrice(details) {
+    var item = details.parentNode;
+    var price = item.querySelector('.element-price') || item;
+    var match = price.textContent.match(
+        /[$\u00a3\u20ac]\s*\d+(?:[.,]\d+)?|\d+(?:[.,]\d+)?\s*(?:[$\u00a3\u20ac]|kr|z\u0142|Ft|K\u010d)/);
+    return match ? match[0] : null;
+}
+"""
 
-        self.datafiles = {}
+# element IDs (6-7 digits), add button state and price of every element listed on the page
+CATALOG_SCRIPT = r"""
+var elements = [];
+document.querySelectorAll('.element-details').forEach(function (details) {
+    var button = details.nextElementSibling;
+    if (button && button.tagName === 'BUTTON') {
+        elements.push([details.textContent.match(/\b\d{6,7}\b/g) || [], !button.disabled,
+                       elementPrice(details)]);
+    }
+});
+return elements;
+""" + PRICE_FUNCTION
+
+# price of the element with the given element ID (arguments[0]) in the element list
+PRICE_SCRIPT = r"""
+var details = document.querySelectorAll('.element-details');
+for (var i = 0; i < details.length; i++) {
+    if (new RegExp('\\b' + arguments[0] + '\\b').test(details[i].textContent)) {
+        return elementPrice(details[i]);
+    }
+}
+return null;
+""" + PRICE_FUNCTION
+
+# click the add button of the element with the given element ID
+ADD_ELEMENT_SCRIPT = r"""
+var details = document.querySelectorAll('.element-details');
+for (var i = 0; i < details.length; i++) {
+    if (new RegExp('\\b' + arguments[0] + '\\b').test(details[i].textContent)) {
+        details[i].nextElementSibling.click();
+        return true;
+    }
+}
+return false;
+"""
 
-        # future objects to manage elements
-        self.updated_parts = None
-        self.electric_parts = None
+# click the add buttons of the given element IDs (arguments[0]), return for
+# each of them true if clicked, false if disabled, null if not listed
+ADD_ELEMENTS_SCRIPT = r"""
+var details = document.querySelectorAll('.element-details');
+return arguments[0].map(function (elementId) {
+    var pattern = new RegExp('\\b' + elementId + '\\b');
+    for (var i = 0; i < details.length; i++) {
+        if (pattern.test(details[i].textContent)) {
+            var button = details[i].nextElementSibling;
+            if (button.disabled) {
+                return false;
+            }
+            button.click();
+            return true;
+        }
+    }
+    return null;
+});
+"""
 
-        # inventory of added electric parts in order process
-        self.electric_part_list = []
+# element ID and selected quantity (the text of the selected option) of every item in the bag
+BAG_SCRIPT = r"""
+return Array.prototype.map.call(document.querySelectorAll('.bag-item'), function (item) {
+    var elementId = item.getAttribute('data-element-id') ||
+        (item.textContent.match(/\b\d{6,7}\b/) || [''])[0];
+    var select = item.querySelector('select');
+    return [elementId, select && select.selectedIndex >= 0 ?
+        select.options[select.selectedIndex].text.trim() : null];
+});
+"""
 
-        self.partno_status = {
-            'found': 1,
-            'not_found': 2,
-            'electric': 3,
+# select the options with the text of the given [element ID, quantity] pairs (arguments[0])
+# in the bag, like Select.select_by_visible_text: an option's value may differ from its text
+BAG_QUANTITIES_SCRIPT = r"""
+var quantities = {};
+arguments[0].forEach(function (pair) {
+    quantities[pair[0]] = pair[1];
+});
+document.querySelectorAll('.bag-item').forEach(function (item) {
+    var elementId = item.getAttribute('data-element-id') ||
+        (item.textContent.match(/\b\d{6,7}\b/) || [''])[0];
+    var select = item.querySelector('select');
+    if (select && quantities.hasOwnProperty(elementId)) {
+        for (var i = 0; i < select.options.length; i++) {
+            if (select.options[i].text.trim() === String(quantities[elementId])) {
+                select.selectedIndex = i;
+                select.dispatchEvent(new Event('change', {bubbles: true}));
+                break;
+            }
         }
+    }
+});
+"""
 
-        #  set statistics counters to zero
-        self.part_stats_counter = {
-            'total_elements': 0,
-            'found': 0,
-            'duplicate_part': 0,
-            'not_in_set': 0,
-            'out_of_stock': 0,
-            'electric_part': 0
+# click the remove button of the element ID in the bag
+BAG_REMOVE_SCRIPT = r"""
+var items = document.querySelectorAll('.bag-item');
+for (var i = 0; i < items.length; i++) {
+    if (new RegExp('\\b' + arguments[0] + '\\b').test(
+            items[i].getAttribute('data-element-id') || items[i].textContent)) {
+        var button = items[i].querySelector('button');
+        if (button) {
+            button.click();
+            return true;
         }
+    }
+}
+return false;
+"""
 
-    def _process_survey_age_country(self):
-        try:
-            print("* They want to know how old we are.")
-            age_field = self.wait.until(EC.element_to_be_clickable(
-                (By.NAME, 'rpAgeAndCountryAgeField')))
-            age_field.send_keys('55')
-            age_field.send_keys(Keys.RETURN)
 
-            # wait for age_field's DOM element to be removed
-            self.wait.until(EC.staleness_of(age_field))
+class RateLimiter:
+    """
+    Space out calls from any number of threads to at most ``rate`` per second
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until the next call is allowed
+        """
+        with self.lock:
+            now = monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            sleep(delay)
+
+
+class LookupPool:
+    """
+    Look up parts concurrently in a pool of headless browser workers.
+
+    ``new_worker`` returns a ReplacementPart with a browser on the selected
+    set's page.  A worker that fails, or its periodic health check, is
+    replaced by a new one up to ``max_restarts`` times; its part goes back
+    to the queue.  Parts nobody could look up are missing from the result.
+    """
+
+    def __init__(self, new_worker, workers=2, rate=None, health_check_every=20, max_restarts=2):
+        self.new_worker = new_worker
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.health_check_every = health_check_every
+        self.max_restarts = max_restarts
+        self.restarts = 0
+
+    def lookup(self, part_numbers):
+        """
+        Look up all part numbers
+
+        return dict, part number -> result of ReplacementPart.lookup()
+        """
+        queue = Queue()
+        for part_no in part_numbers:
+            queue.put(part_no)
+
+        results = {}
+        threads = [threading.Thread(target=self._work, args=(queue, results))
+                   for worker in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def _work(self, queue, results):
+        """
+        Look up parts from the queue until it's empty or we gave up
+        """
+        worker = None
+        restarts = 0
+        lookups = 0
+
+        while restarts <= self.max_restarts:
+            try:
+                part_no = queue.get_nowait()
+            except Empty:
+                break
+
+            try:
+                if worker is None:
+                    worker = self.new_worker()
+                elif lookups % self.health_check_every == 0 and not worker.is_healthy():
+                    raise WebDriverException("health check failed")
+
+                self.rate_limiter.acquire()
+                results[part_no] = worker.lookup(part_no, check_stock=True)
+                lookups += 1
+            except (WebDriverException, SystemExit) as err:
+                print("!!! Lookup worker failed, restarting: {}".format(err))
+                queue.put(part_no)
+                restarts += 1
+                self.restarts += 1
+                if worker is not None:
+                    worker.close()
+                    worker = None
+
+        if worker is not None:
+            worker.close()
+
+
+class ReplacementPart(LegoShopBase):
+    """
+    Add a list of LEGO parts and their quantity to the 'Shopping Bag' of LEGO's
+    customer service platform.  A browser window will be opened, you'll be able
+    to watch the browser do what you would normally do by hand, and execution
+    will stop after all pieces have been added, so you can review and finalize
+    your order.  (This is just to help you save time on entering 60+ pieces
+    manually.  Nothing is ordered on your behalf!)
+    """
+
+    def __init__(self, browser_name=None, shop=None, headless=False):
+        super().__init__(browser_name, shop, headless)
+
+        self.datafiles = {}
+
+        self.trace_file = None
+
+        # journal of the processed parts, to resume an interrupted order
+        self.journal_file = None
+        self.resume = False
+        self.journal = None
+
+        # number of found parts added to the bag by a few scripts at once
+        self.batch_size = 1
+
+        # look for the parts not in the set in other sets of the combined list
+        self.fallback_sets = False
+
+        # only add, adjust or remove what differs from the bag's content
+        self.reconcile = False
+
+        # what the shop said about the parts of a set in earlier orders
+        self.availability = AvailabilityCache()
+        self.lego_set = None
+
+        # headless browsers looking up parts concurrently, and their results
+        self.lookup_workers = 0
+        self.lookup_rate = None
+        self.lookups = {}
+
+        # future objects to manage elements
+        self.updated_parts = None
+        self.electric_parts = None
+
+        # inventory of added electric parts in order process
+        self.electric_part_list = []
+
+        # element ID -> add button enabled (and price), for all elements of the selected set
+        self.catalog = {}
+        self.prices = {}
+        self.last_search = None
+        self.selected_set = None
+
+        self.partno_status = {
+            'found': 1,
+            'not_found': 2,
+            'electric': 3,
+            'out_of_stock': 4,
+        }
+
+        self.part_stats_counter = {}
+        self._reset_order()
+
+    def _reset_order(self):
+        """
+        Forget everything about the last order, to process another one
+        with the same browser
+        """
+        self.lookups = {}
+        self.electric_part_list = []
+        self.journal = None
+
+        # original part no -> statistics counter name, of the processed parts
+        self.outcomes = {}
+        # part no -> part no replacing it, merged in the order list
+        self.merged = {}
+
+        #  set statistics counters to zero
+        self.part_stats_counter = {
+            'total_elements': 0,
+            'found': 0,
+            'duplicate_part': 0,
+            'not_in_set': 0,
+            'out_of_stock': 0,
+            'electric_part': 0,
+            'in_bag': 0,
+            'removed': 0
+        }
+
+    def _process_survey_age_country(self):
+        try:
+            print("* They want to know how old we are.")
+            age_field = self.wait.until(EC.element_to_be_clickable(
+                (By.NAME, 'rpAgeAndCountryAgeField')))
+            age_field.send_keys('55')
+            age_field.send_keys(Keys.RETURN)
+
+            # wait for age_field's DOM element to be removed
+            self.wait.until(EC.staleness_of(age_field))
         except TimeoutException:
             print("!!! Something's wrong with the survey")
 
     def __process_select_lego_set(self, lego_set):
         """
-        Manage Lego's Set choice
+        Manage Lego's Set choice, also switching from the element page of
+        another set
+
+        return boolean, False if the element list of another set didn't go away
         """
 
         print("* We need to tell them which set we want to buy parts from: {lego_set}".format(
@@ -418,70 +1383,399 @@ class ReplacementPart(LegoShopBase):
             EC.element_to_be_clickable(
                 (By.CSS_SELECTOR, '.product-search input[ng-model=productNumber]'))
         )
+        # the element list of the previous set stays until the new one is shown
+        previous = self.browser.find_elements_by_css_selector('.element-details')[:1]
 
+        setno_field.clear()
         setno_field.send_keys(lego_set)
         setno_field.send_keys(Keys.RETURN)
-        sleep(.3)  # seconds
 
-    def __process_partno(self, original_part_no):
+        if not previous:
+            self.adaptive_wait.until('select set', EC.element_to_be_clickable(
+                (By.ID, 'element-filter')), fixed_sleep=.3, required=False)
+            return True
+
+        if self.adaptive_wait.until('switch set', EC.staleness_of(previous[0]),
+                                    fixed_sleep=.3, required=False) is None:
+            print("!!! The elements of the previous set are still shown, set {lego_set} wasn't"
+                  " selected.".format(lego_set=lego_set))
+            return False
+        return True
+
+    def __process_prefetch_catalog(self):
         """
-        Ensure a part is found, or test with newer ID
+        Read the element list of the selected set once, so that parts can
+        be looked up without a shop search for each of them
         """
+        print("* Let's read the list of elements in the set.")
+        self.catalog = {}
+        self.prices = {}
 
-        return_code = self.partno_status['not_found']
+        # the set's page is shown already, a shop without element list only
+        # has the search field: don't wait long for a list that never comes
+        try:
+            listed = self.adaptive_wait.until('element list', EC.presence_of_element_located(
+                (By.CSS_SELECTOR, '.element-details + button')), required=False, expected=False,
+                maximum=1)
+            elements = self.browser.execute_script(CATALOG_SCRIPT) if listed else []
+        except WebDriverException:
+            elements = []
+
+        for element_ids, enabled, price in elements:
+            for element_id in element_ids:
+                self.catalog[int(element_id)] = enabled
+                self.prices[int(element_id)] = price
+
+        if self.catalog:
+            print("{count} elements listed, no need to search for each part."
+                  .format(count=len(self.catalog)))
+        else:
+            print("No element list shown, we'll search for each part.")
 
-        original_part_no = int(original_part_no)
-        new_part_no_list = self.updated_parts.get_part_list(original_part_no)
-        # merge original part number with his alternatives
-        partno_list = list([original_part_no] + new_part_no_list)
+    def __read_bag(self):
+        """
+        Read the element IDs and quantities in the shopping bag at once
 
-        part_no = None
+        return dict, element ID -> quantity (string)
+        """
+        try:
+            items = self.browser.execute_script(BAG_SCRIPT)
+        except WebDriverException:
+            print("!!! Could not read the shopping bag")
+            return {}
+
+        return {int(element_id): quantity for element_id, quantity in items if element_id}
+
+    def __select_in_bag(self, part_no, quantity):
+        """
+        Select the quantity of a part in the bag by its visible text, as
+        for a part added on its own
+
+        return string, the selected quantity, or None if it's not in the bag
+        """
+        for item in self.browser.find_elements_by_css_selector('.bag-item'):
+            if re.search(r'\b{}\b'.format(part_no),
+                         item.get_attribute('data-element-id') or item.text):
+                return select_quantity(Select(item.find_element_by_css_selector('select')),
+                                       quantity)
+        return None
+
+    def __find_in_bag(self, original_part_no, bag):
+        """
+        Find a part in the bag, by its ID or one of its new IDs
 
-        for idx, part_no in enumerate(partno_list):
+        return int or None
+        """
+        for part_no in [original_part_no] + self.updated_parts.get_part_list(original_part_no):
+            if part_no in bag:
+                return part_no
+        return None
+
+    def __done(self, original_part_no, bag):
+        """
+        Tell if a part is in the bag or journaled already
+        """
+        entry = self.journal.get(original_part_no) if self.journal else None
+        if entry and entry['outcome'] != 'pending':
+            return True
+        return self.__find_in_bag(original_part_no, bag) is not None
+
+    def __replay(self, entry, added_part):
+        """
+        Count a part processed before the order was interrupted
+        """
+        outcome = entry['outcome']
+        self.part_stats_counter[outcome] += 1
+        self.outcomes[entry['part_no']] = outcome
+
+        if outcome in ('found', 'out_of_stock'):
+            added_part[entry['element_id']] = entry['part_no']
+        elif outcome == 'electric_part':
+            self.electric_part_list.append(entry['element_id'])
+
+        print("Done before ({outcome}), skipped.".format(outcome=outcome.replace('_', ' ')))
+
+    def __journal(self, original_part_no, part_no, outcome, quantity=None):
+        self.outcomes[original_part_no] = outcome
+        if self.journal:
+            self.journal.record(original_part_no, part_no, outcome, quantity)
 
-            # idx 0 has the original part_no
-            if idx > 0:
-                print("\t>> Trying to replace with #{pn} ".format(pn=part_no), end='')
+    def __journal_pending(self, original_part_no, part_no, quantity):
+        """
+        Write down a part about to be added to the bag, before clicking it
+        """
+        if self.journal:
+            self.journal.record(original_part_no, part_no, 'pending', quantity)
+
+    def __remove_from_bag(self, bag, keep):
+        """
+        Remove the elements in the bag that aren't in the order list
+        """
+        for element_id in sorted(set(bag) - keep):
+            with self.tracer.span('remove from bag', part_no=element_id):
+                removed = self.browser.execute_script(BAG_REMOVE_SCRIPT, element_id)
+
+            if removed:
+                print("- #{pn} removed from the bag, it's not in the order list".format(
+                    pn=element_id))
+                self.part_stats_counter['removed'] += 1
+            else:
+                print("!! WARNING: Could not remove #{pn} from the bag".format(pn=element_id))
 
+    def __search_partno(self, part_no):
+        """
+        Count the elements matching a part number, in the prefetched
+        element list if we have one, by a shop search otherwise
+
+        return int
+        """
+        if self.catalog:
+            return 1 if part_no in self.catalog else 0
+
+        with self.tracer.span('search', part_no=part_no):
             element_field = self.wait.until(
                 EC.element_to_be_clickable((By.ID, 'element-filter')))
             element_field.clear()
             element_field.send_keys(part_no)
+            self.last_search = part_no
+            listed = self.browser.find_elements_by_css_selector('.element-details')
+            self.adaptive_wait.arm_dom_mutation()
             element_field.send_keys(Keys.RETURN)
-            sleep(.3)  # seconds
+            # no results stay no results when searching for another missing
+            # part, nothing shows that the search is done then
+            self.adaptive_wait.until('search', self.adaptive_wait.search_done(part_no),
+                                     fixed_sleep=.3, required=False, expected=bool(listed))
 
-            try:
-                # tip: count results to ensure the wanted part_no return nothing or one
-                results_count = len(
-                    self.browser.find_elements_by_css_selector('.element-details + button'))
-
-                if results_count == 0:
-
-                    if self.electric_parts.partno_exists(part_no):
-                        return_code = self.partno_status['electric']
-                        break
-
-                    if idx == 0 and len(partno_list) > 1:
-                        # we're on the original part, and we've a list of new Element ID
-                        print("Not Found, but has a chain of other Element ID:")
-                        # a comment about the mapping
-                        comment = self.updated_parts.get_part_comment(original_part_no)
-                        print("\tcomment: {}".format(comment))
-                    else:
-                        print("Not Found!")
-
-                elif results_count == 1:
-                    return_code = self.partno_status['found']
+            # tip: count results to ensure the wanted part_no return nothing or one
+            return len(self.browser.find_elements_by_css_selector('.element-details + button'))
+
+    def __add_partno(self, part_no):
+        """
+        Click the add button of a found part
+
+        return boolean, False if the part is out of stock
+        """
+        if self.catalog:
+            if not self.catalog[part_no]:
+                return False
+            return self.browser.execute_script(ADD_ELEMENT_SCRIPT, part_no)
+
+        if self.last_search != part_no:
+            # looked up by another browser
+            self.__search_partno(part_no)
+
+        add_button = self.browser.find_element_by_css_selector('.element-details + button')
+
+        if not add_button.is_enabled():
+            return False
+
+        add_button.click()
+        return True
+
+    def __in_stock(self, part_no):
+        """
+        Tell if the add button of a found part is enabled
+
+        return boolean
+        """
+        if self.catalog:
+            return self.catalog[part_no]
+
+        return self.browser.find_element_by_css_selector(
+            '.element-details + button').is_enabled()
+
+    def lookup(self, original_part_no, check_stock=False):
+        """
+        Search a part, or test with newer IDs, without printing anything
+
+        return (part_no, status, attempts) with the (part_no, results_count)
+        of each search in attempts, results_count None on Selenium errors
+        """
+
+        status = self.partno_status['not_found']
+
+        original_part_no = int(original_part_no)
+        new_part_no_list = self.updated_parts.get_part_list(original_part_no)
+        # merge original part number with his alternatives
+        partno_list = list([original_part_no] + new_part_no_list)
+
+        cached = self.availability.get(self.lego_shop, self.lego_set, original_part_no)
+        if cached is not None:
+            part_no, status, in_stock = cached
+            if status in (self.partno_status['not_found'], self.partno_status['electric']):
+                return part_no, status, []
+            # try the element ID that worked last time first
+            if part_no in partno_list:
+                partno_list.remove(part_no)
+                partno_list.insert(0, part_no)
+
+        part_no = None
+        attempts = []
+
+        with self.tracer.span('lookup', part_no=original_part_no):
+            for part_no in partno_list:
+                try:
+                    results_count = self.__search_partno(part_no)
+                except NoSuchElementException:
+                    results_count = None
+
+                attempts.append((part_no, results_count))
+
+                if results_count == 0 and self.electric_parts.partno_exists(part_no):
+                    status = self.partno_status['electric']
                     break
 
-                else:
-                    print("Too many results with that part_no, bad number!")
+                if results_count == 1:
+                    status = self.partno_status['found']
+                    if part_no != original_part_no:
+                        self.updated_parts.record_found(part_no)
+                    if check_stock and not self.__in_stock(part_no):
+                        status = self.partno_status['out_of_stock']
+                    break
+
+        # a search that failed tells nothing, don't remember the part as not
+        # found unless all its element IDs were searched successfully
+        if status != self.partno_status['not_found'] or all(
+                results_count is not None for _, results_count in attempts):
+            self.availability.put(self.lego_shop, self.lego_set, original_part_no, part_no,
+                                  status)
+        return part_no, status, attempts
+
+    def __process_partno(self, original_part_no):
+        """
+        Ensure a part is found, or test with newer ID
+        """
+        original_part_no = int(original_part_no)
+
+        # looked up by the pool already?
+        lookup = self.lookups.get(original_part_no) or self.lookup(original_part_no)
+        part_no, return_code, attempts = lookup
+        has_chain = len(self.updated_parts.get_part_list(original_part_no)) > 0
+
+        if not attempts and return_code == self.partno_status['not_found']:
+            print("Not Found! (known from an earlier order)")
+
+        for idx, (attempt_part_no, results_count) in enumerate(attempts):
 
-            except NoSuchElementException:
+            if attempt_part_no != original_part_no:
+                print("\t>> Trying to replace with #{pn} ".format(pn=attempt_part_no), end='')
+
+            if results_count is None:
                 print("!!! Selenium error: CSS element not found")
 
+            elif results_count == 0:
+
+                if return_code == self.partno_status['electric'] and idx == len(attempts) - 1:
+                    break
+
+                if attempt_part_no == original_part_no and has_chain:
+                    # we're on the original part, and we've a list of new Element ID
+                    print("Not Found, but has a chain of other Element ID:")
+                    # a comment about the mapping
+                    comment = self.updated_parts.get_part_comment(original_part_no)
+                    print("\tcomment: {}".format(comment))
+                else:
+                    print("Not Found!")
+
+            elif results_count > 1:
+                print("Too many results with that part_no, bad number!")
+
         return part_no, return_code
 
+    def __process_lookup_pool(self, lego_set, order_list):
+        """
+        Look up all ordered parts in a pool of headless browsers
+        """
+        part_numbers = sorted({int(brick.split(':')[0]) for brick in order_list})
+
+        print("* Let's look up {count} parts with {workers} headless browsers.".format(
+            count=len(part_numbers), workers=self.lookup_workers))
+        start = monotonic()
+
+        pool = LookupPool(lambda: self._new_lookup_worker(lego_set),
+                          self.lookup_workers, self.lookup_rate)
+        self.lookups = pool.lookup(part_numbers)
+
+        print("Looked up {count} parts in {seconds:.1f}s ({restarts} worker restarts).".format(
+            count=len(self.lookups), seconds=monotonic() - start, restarts=pool.restarts))
+
+    def _load_datafiles(self):
+        """
+        Load the new element IDs and electric parts, unless loaded already
+        for an earlier order
+        """
+        if self.updated_parts is None:
+            self.updated_parts = UpdatedPartMapping(self.datafiles['newelementid'])
+        if self.electric_parts is None:
+            self.electric_parts = MindstormsElectricPart(self.datafiles['electricparts'])
+
+    def __price(self, part_no):
+        """
+        Price of a found part, from the element list or the search result
+
+        return string or None if the shop doesn't show one
+        """
+        if self.catalog:
+            return self.prices.get(part_no)
+        try:
+            return self.browser.execute_script(PRICE_SCRIPT, part_no)
+        except WebDriverException:
+            return None
+
+    def check_availability(self, lego_set, part_numbers):
+        """
+        Look up parts in a set without adding them to the bag
+
+        return dict, part no -> (outcome, element ID found, price); outcome is
+        a statistics counter name: found, out_of_stock, not_in_set or electric_part
+        """
+        outcomes = {
+            self.partno_status['found']: 'found',
+            self.partno_status['out_of_stock']: 'out_of_stock',
+            self.partno_status['not_found']: 'not_in_set',
+            self.partno_status['electric']: 'electric_part',
+        }
+        self._load_datafiles()
+        self.lego_set = lego_set
+
+        self._open_shop(login=False)
+        self.__process_select_lego_set(lego_set)
+        self.__process_prefetch_catalog()
+
+        results = {}
+        for original_part_no in part_numbers:
+            part_no, status, _ = self.lookup(original_part_no, check_stock=True)
+            outcome = outcomes[status]
+            if outcome in ('found', 'out_of_stock'):
+                results[original_part_no] = (outcome, part_no, self.__price(part_no))
+            else:
+                results[original_part_no] = (outcome, None, None)
+        return results
+
+    def _new_lookup_worker(self, lego_set):
+        """
+        Open a headless browser on the set's page for looking up parts
+        """
+        worker = ReplacementPart(self.browser_name, self.lego_shop, headless=True)
+        worker.base_url = self.base_url
+        worker.tracer = self.tracer
+        worker.updated_parts = self.updated_parts
+        worker.electric_parts = self.electric_parts
+        worker.availability = self.availability
+        worker.lego_set = lego_set
+        # a browser profile can't be used by several browsers at once
+        worker.set_session(cookie_jar=self.cookie_jar)
+
+        try:
+            worker._open_shop(login=False)
+            worker.__process_select_lego_set(lego_set)
+            worker.__process_prefetch_catalog()
+        except WebDriverException:
+            worker.close()
+            raise
+
+        return worker
+
     def __process_statistics(self):
         """
         Print statistics about ordered parts
@@ -497,6 +1791,16 @@ class ReplacementPart(LegoShopBase):
         print("- {s} Elements out of stock".format(s=self.part_stats_counter['out_of_stock']))
         print("- {s} Elements of type 'Electric part'"
               .format(s=self.part_stats_counter['electric_part']))
+        if self.reconcile:
+            print("- {s} Elements in the bag already"
+                  .format(s=self.part_stats_counter['in_bag']))
+            print("- {s} Elements removed from the bag"
+                  .format(s=self.part_stats_counter['removed']))
+
+        print()
+        self.adaptive_wait.report()
+        print()
+        self.tracer.summary()
 
         print()
         print("We're done. You can finalize your order now. Thanks for watching!")
@@ -525,44 +1829,436 @@ class ReplacementPart(LegoShopBase):
         """
         self.datafiles['electricparts'] = datafile
 
-    def process(self, lego_set, order_list):
+    def set_lookup_workers(self, workers, rate=None):
         """
-        Main process to order LEGO's set parts
+        Set number of headless browsers looking up parts concurrently,
+        and the maximum number of lookups per second for all of them
         """
+        self.lookup_workers = workers
+        self.lookup_rate = rate
 
-        self.updated_parts = UpdatedPartMapping(self.datafiles['newelementid'])
-        self.electric_parts = MindstormsElectricPart(self.datafiles['electricparts'])
+    def set_journal(self, filename, resume=False):
+        """
+        Set file to journal the processed parts to, and whether to resume
+        the order journaled there, skipping all parts done already
+        """
+        self.journal_file = filename
+        self.resume = resume
+
+    def set_batch_size(self, batch_size):
+        """
+        Set number of found parts to add to the bag at once, when the shop
+        lists all elements of the set
+        """
+        self.batch_size = batch_size
 
+    def set_combined_list_datafile(self, datafile):
+        """
+        Set path to the combined list, to find other sets having a part
+        """
+        self.datafiles['combinedlist'] = datafile
+
+    def set_fallback_sets(self, fallback_sets=True):
+        """
+        Look for the parts not in the set in as few other sets as possible
+        """
+        self.fallback_sets = fallback_sets
+
+    def set_reconcile(self, reconcile=True):
+        """
+        Only add, adjust or remove the parts in which the bag differs from
+        the order list, e.g. to continue an interrupted order
+        """
+        self.reconcile = reconcile
+
+    def set_availability_cache(self, filename, ttl=24 * 3600, max_entries=10000):
+        """
+        Set file to keep the shop's answers about parts in between orders,
+        and how long (seconds) and how many of them to keep
+        """
+        self.availability = AvailabilityCache(filename, ttl, max_entries)
+
+    def _open_shop(self, login=True):
+        """
+        Open the shop ready to select a set.  The survey, cookie, age and
+        login steps are skipped when a restored session doesn't need them.
+
+        return boolean, False if the login failed
+        """
         # simulate click to the third button ('Buy Bricks')
-        self._init_browser(self.browser_name,
-                           self.lego_shop + "/service/replacementparts/sale?chosenFlow=3")
-        self._process_survey()
-        self._process_cookies_accept()
-        self._process_survey_age_country()
+        url_path = self.lego_shop + "/service/replacementparts/sale?chosenFlow=3"
+        ready_locator = (By.CSS_SELECTOR, '.product-search input[ng-model=productNumber]')
+
+        if self.is_alive():
+            # a browser of an earlier order, past the gates and logged in already
+            self.shop_url = self.base_url + url_path
+            self._timed('load page', self.browser.get, self.shop_url)
+            if self._timed('check session', self._session_ready, ready_locator):
+                print("* Browser of an earlier order, no survey, cookies, age or login needed.")
+                return True
+        else:
+            self._init_browser(self.browser_name, url_path)
 
-        if not self._process_login():
-            return
+        if self._timed('restore session', self._restore_session, ready_locator):
+            print("* Restored session, no survey, cookies, age or login needed.")
+            return True
 
-        self.__process_select_lego_set(lego_set)
+        self._timed('survey', self._process_survey)
+        self._timed('accept cookies', self._process_cookies_accept)
+        self._timed('age and country', self._process_survey_age_country)
+
+        if not login:
+            return True
+
+        if not self._timed('login', self._process_login):
+            return False
+
+        self._save_session()
+        return True
+
+    def statistics_for(self, order_list):
+        """
+        Statistics of the last order, for a part of its order list
+
+        return dict, in the format of part_stats_counter
+        """
+        statistics = dict.fromkeys(self.part_stats_counter, 0)
+        seen = set()
+
+        for part_no, _ in read_order_list([order_list]):
+            statistics['total_elements'] += 1
+
+            if part_no in seen:
+                statistics['duplicate_part'] += 1
+                continue
+            seen.add(part_no)
+
+            while part_no in self.merged:
+                part_no = self.merged[part_no]
+            if part_no in self.outcomes:
+                statistics[self.outcomes[part_no]] += 1
+
+        return statistics
+
+    def set_trace_file(self, filename):
+        """
+        Set file to write timing spans to (Chrome trace if *.json, else JSON lines)
+        """
+        self.trace_file = filename
+
+    def process(self, lego_set, order_list):
+        """
+        Main process to order LEGO's set parts, writing timing spans at the end
+        """
+        try:
+            self.__process(lego_set, order_list)
+        except WebDriverException:
+            if self.journal:
+                print()
+                print("!!! The order was interrupted, run it again with --resume to continue.")
+            raise
+        finally:
+            if self.journal:
+                self.journal.close()
+            if self.updated_parts is not None:
+                self.updated_parts.save_found_counts()
+            self.availability.save()
+            if self.trace_file:
+                self.tracer.write(self.trace_file)
+                print("Timing spans written to {}".format(self.trace_file))
+
+    def __process(self, lego_set, order_list):
+        """
+        Order LEGO's set parts
+        """
+
+        self._reset_order()
+        self.tracer = Tracer()
+        self._load_datafiles()
+        self.lego_set = lego_set
+
+        order_list = self.__prepare_order_list(order_list)
+
+        if self.journal_file:
+            self.journal = OrderJournal(self.journal_file, self.lego_shop, lego_set, self.resume)
+
+        if self.selected_set == (self.lego_shop, lego_set) and self.is_healthy():
+            print("* Set {lego_set} is selected already.".format(lego_set=lego_set))
+        else:
+            # another set of the same shop is selected from the element page
+            same_shop = (self.selected_set is not None and
+                         self.selected_set[0] == self.lego_shop and self.is_healthy())
+            self.selected_set = None
+            self.catalog = {}
+            self.last_search = None
+
+            if not same_shop:
+                if not self._open_shop():
+                    return
+
+                self.print_startup_times()
+
+            with self.tracer.span('select set', lego_set=lego_set):
+                if not self.__process_select_lego_set(lego_set):
+                    return
+            with self.tracer.span('prefetch catalog'):
+                self.__process_prefetch_catalog()
+            self.selected_set = (self.lego_shop, lego_set)
 
         print("Let's scroll the page down a bit, so we can see things better.")
         self.browser.execute_script("window.scroll(0, 750);")
 
-        order_list = order_list.split(',')
-
-        self.part_stats_counter['total_elements'] = len(order_list)
+        bag = {}
+        if self.reconcile:
+            with self.tracer.span('read bag'):
+                bag = self.__read_bag()
+            print("* {count} elements in the bag already, we'll only change what differs."
+                  .format(count=len(bag)))
+        elif self.journal and self.journal.pending():
+            # parts the interrupted order was adding may be in the bag already
+            pending = self.journal.pending()
+            with self.tracer.span('read bag'):
+                bag = {part_no: quantity for part_no, quantity in self.__read_bag().items()
+                       if part_no in pending}
+            print("* {count} of {pending} parts being added before the interruption are in the"
+                  " bag.".format(count=len(bag), pending=len(pending)))
+
+        if self.lookup_workers and not self.catalog:
+            lookup_list = [brick for brick in order_list
+                           if not self.__done(int(brick.split(':')[0]), bag)]
+            with self.tracer.span('lookup pool', parts=len(lookup_list)):
+                self.__process_lookup_pool(lego_set, lookup_list)
 
         print("That's gonna be crazy: {count} elements to order! Let's rock.".format(
-            count=self.part_stats_counter['total_elements']))
+            count=len(order_list)))
         print()
 
-        self.__process_order_list(lego_set, order_list)
+        self.__process_order_list(lego_set, order_list, bag)
+        if self.fallback_sets:
+            self.__process_fallback_sets(lego_set, order_list)
         self.browser.execute_script("window.scroll(0, 0);")
         self.__process_statistics()
 
-    def __process_order_list(self, lego_set, order_list=None):
+    def __add_to_bag(self, lego_set, original_part_no, part_no, quantity):
+        """
+        Add a found part to the bag and select its quantity
+        """
+        with self.tracer.span('add to bag', part_no=part_no):
+            bag_size = len(self.browser.find_elements_by_css_selector('.bag-item select'))
+
+            self.__journal_pending(original_part_no, part_no, quantity)
+            in_stock = self.__add_partno(part_no)
+            self.availability.put(self.lego_shop, lego_set, original_part_no, part_no,
+                                  self.partno_status['found'], in_stock)
+            if in_stock:
+                self.part_stats_counter['found'] += 1
+            else:
+                self.part_stats_counter['out_of_stock'] += 1
+                print("\t!! NOTE: item out of stock.")
+                self.__journal(original_part_no, part_no, 'out_of_stock')
+                return
+
+            # set the value for item's quantity drop-down menu, once it's in the bag
+            try:
+                amount_select = self.adaptive_wait.until(
+                    'add to bag', lambda driver: driver.find_elements_by_css_selector(
+                        '.bag-item select')[bag_size:], fixed_sleep=.2)[-1]
+            except TimeoutException:
+                print("\t!! WARNING: Item did not show up in the bag.")
+                return
+
+        with self.tracer.span('select quantity', part_no=part_no, quantity=quantity):
+            # ensure the value is correct
+            selected = select_quantity(Select(amount_select), quantity)
+
+        if quantity != selected:
+            print("\t!! WARNING: Could not select desired quantity. {} != {}".format(
+                quantity, selected))
+        self.__journal(original_part_no, part_no, 'found', selected)
+
+    def __add_batch(self, lego_set, pending):
+        """
+        Add found parts to the bag and select their quantities with a few
+        scripts for all of them, and one read of the bag to verify them.
+        Parts the batch didn't get right are handled one at a time.
+        """
+        print("* Let's add {count} parts to the bag at once.".format(count=len(pending)))
+
+        def bag_element_ids(driver):
+            return {int(element_id) for element_id, _ in driver.execute_script(BAG_SCRIPT)
+                    if element_id}
+
+        added = []
+        single = []
+
+        with self.tracer.span('add to bag', parts=len(pending)):
+            for item in pending:
+                self.__journal_pending(*item)
+            clicked = self.browser.execute_script(
+                ADD_ELEMENTS_SCRIPT, [part_no for _, part_no, _ in pending])
+
+            for item, in_stock in zip(pending, clicked):
+                original_part_no, part_no, quantity = item
+                if in_stock is None:
+                    # not listed (any more)
+                    single.append(item)
+                    continue
+
+                self.availability.put(self.lego_shop, lego_set, original_part_no, part_no,
+                                      self.partno_status['found'], in_stock)
+                if in_stock:
+                    self.part_stats_counter['found'] += 1
+                    added.append(item)
+                else:
+                    self.part_stats_counter['out_of_stock'] += 1
+                    print("\t!! NOTE: #{pn} out of stock.".format(pn=part_no))
+                    self.__journal(original_part_no, part_no, 'out_of_stock')
+
+            wanted = {part_no for _, part_no, _ in added}
+            try:
+                self.adaptive_wait.until(
+                    'add to bag batch', lambda driver: wanted <= bag_element_ids(driver),
+                    fixed_sleep=.2)
+            except TimeoutException:
+                pass
+
+        with self.tracer.span('select quantity', parts=len(added)):
+            self.browser.execute_script(
+                BAG_QUANTITIES_SCRIPT, [[part_no, quantity] for _, part_no, quantity in added])
+            bag = self.__read_bag()
+
+        for original_part_no, part_no, quantity in added:
+            if part_no not in bag:
+                print("\t!! WARNING: #{pn} did not show up in the bag.".format(pn=part_no))
+                continue
+
+            selected = bag[part_no]
+            if selected != quantity:
+                with self.tracer.span('select quantity', part_no=part_no, quantity=quantity):
+                    selected = self.__select_in_bag(part_no, quantity)
+
+            if selected != quantity:
+                print("\t!! WARNING: Could not select desired quantity of #{pn}. {} != {}"
+                      .format(quantity, selected, pn=part_no))
+            self.__journal(original_part_no, part_no, 'found', selected)
+
+        for item in single:
+            self.__add_to_bag(lego_set, *item)
+
+    def __prepare_order_list(self, order_list):
+        """
+        Read the order list (a string, or lines of a file), merge duplicate
+        parts, also a part with the new ID replacing it, and split off the
+        electric parts and the parts that aren't sold separately any longer,
+        so that only parts the set may have are searched in the shop
+
+        return list of part_number:quantity strings
         """
-        Add set's parts to the bag
+        if isinstance(order_list, str):
+            order_list = [order_list]
+
+        quantities = {}
+        for part_no, quantity in read_order_list(order_list):
+            self.part_stats_counter['total_elements'] += 1
+            if part_no in quantities:
+                self.part_stats_counter['duplicate_part'] += 1
+            quantities[part_no] = quantities.get(part_no, 0) + quantity
+
+        for part_no in list(quantities):
+            if part_no not in quantities:
+                continue
+
+            new_part_nos = self.updated_parts.get_part_list(part_no)
+
+            if new_part_nos == [0]:
+                print("* #{pn} isn't sold separately any longer, comment: {comment}".format(
+                    pn=part_no, comment=self.updated_parts.get_part_comment(part_no)))
+                del quantities[part_no]
+                self.part_stats_counter['not_in_set'] += 1
+                self.outcomes[part_no] = 'not_in_set'
+
+            elif self.electric_parts.partno_exists(part_no):
+                print("* #{pn} is an electric part, see note at the end.".format(pn=part_no))
+                del quantities[part_no]
+                self.electric_part_list.append(part_no)
+                self.part_stats_counter['electric_part'] += 1
+                self.outcomes[part_no] = 'electric_part'
+
+            else:
+                listed = [new_part_no for new_part_no in new_part_nos
+                          if new_part_no in quantities and new_part_no != part_no]
+                if listed:
+                    new_part_no = listed[0]
+                    quantities[new_part_no] += quantities.pop(part_no)
+                    self.merged[part_no] = new_part_no
+                    self.part_stats_counter['duplicate_part'] += 1
+                    print("* #{pn} is replaced by #{new_pn}, which is in the order list, too."
+                          .format(pn=part_no, new_pn=new_part_no))
+
+        return ['{pn}:{qty}'.format(pn=part_no, qty=quantity)
+                for part_no, quantity in quantities.items()]
+
+    def __process_fallback_sets(self, lego_set, order_list):
+        """
+        Visit the fewest other sets having the parts not in the set, each
+        once, and add the parts from there
+        """
+        quantities = {}
+        for brick in order_list:
+            part_no, quantity = brick.split(':')
+            if self.outcomes.get(int(part_no)) == 'not_in_set':
+                quantities[int(part_no)] = quantity
+
+        if not quantities:
+            return
+
+        datafile = self.datafiles['combinedlist']
+        if inventory.is_database(datafile):
+            matrix = inventory.PartDatabase(datafile)
+        else:
+            matrix = inventory.InventoryMatrix.load(datafile)
+        set_index = {}
+        for part_no in quantities:
+            sets = matrix.sets_containing(part_no)
+            # a new element ID isn't in the inventories, the ones it replaces are
+            for original_part_no in self.updated_parts.get_original_part_nos(part_no):
+                sets += matrix.sets_containing(original_part_no)
+            set_index[part_no] = list(dict.fromkeys(sets))
+
+        cover, unavailable = inventory.cover_sets(set_index, exclude=[lego_set])
+
+        print()
+        print("* {count} parts aren't in set #{set}, {other} of them are in {sets} other sets."
+              .format(count=len(quantities), set=lego_set,
+                      other=len(quantities) - len(unavailable), sets=len(cover)))
+
+        for fallback_set, part_numbers in cover:
+            print()
+            print("* Let's get {count} parts from set #{set}.".format(
+                count=len(part_numbers), set=fallback_set))
+
+            self.lookups = {}
+            self.lego_set = fallback_set
+            self.selected_set = None
+
+            with self.tracer.span('select set', lego_set=fallback_set):
+                if not self.__process_select_lego_set(fallback_set):
+                    continue
+            # counted again if they aren't in this set either
+            self.part_stats_counter['not_in_set'] -= len(part_numbers)
+            with self.tracer.span('prefetch catalog'):
+                self.__process_prefetch_catalog()
+            self.selected_set = (self.lego_shop, fallback_set)
+
+            self.__process_order_list(fallback_set, [
+                '{pn}:{qty}'.format(pn=part_no, qty=quantities[part_no])
+                for part_no in part_numbers], fallback=True)
+
+    def __process_order_list(self, lego_set, order_list=None, bag=None, fallback=False):
+        """
+        Add set's parts to the bag, or with the ``bag``'s content only
+        what differs from it.  A ``fallback`` set gets the parts not in the
+        set of the order, also when they're journaled as such.
 
         - Detect duplicated ID, out-of-stock, not-in-set
         - Manage quantity
@@ -570,6 +2266,8 @@ class ReplacementPart(LegoShopBase):
         """
         added_part = {}
         counter = 0
+        bag = bag or {}
+        pending = []
 
         for brick in order_list:
             part_no, quantity = brick.split(':')
@@ -582,7 +2280,7 @@ class ReplacementPart(LegoShopBase):
                 qty=quantity,
                 pn=part_no,
                 counter=counter,
-                total_elements=self.part_stats_counter['total_elements']), end='')
+                total_elements=len(order_list)), end='')
 
             # never add the same part twice,
             # otherwise the quantity will be set to the previous part
@@ -599,34 +2297,55 @@ class ReplacementPart(LegoShopBase):
                 print("IGNORE: Electric part already mentioned")
                 continue
 
+            entry = self.journal.get(original_part_no) if self.journal else None
+            if entry and entry['outcome'] != 'pending' and not (
+                    fallback and entry['outcome'] == 'not_in_set'):
+                self.__replay(entry, added_part)
+                continue
+
+            in_bag = self.__find_in_bag(original_part_no, bag) if bag else None
+            if in_bag is not None:
+                added_part[in_bag] = original_part_no
+                self.part_stats_counter['found'] += 1
+                self.part_stats_counter['in_bag'] += 1
+
+                if bag[in_bag] == quantity:
+                    print("Already in the bag!")
+                    self.__journal(original_part_no, in_bag, 'found', quantity)
+                    continue
+
+                with self.tracer.span('select quantity', part_no=in_bag, quantity=quantity):
+                    selected = self.__select_in_bag(in_bag, quantity)
+
+                print("In the bag, quantity changed from {old} to {new}.".format(
+                    old=bag[in_bag], new=selected))
+                if quantity != selected:
+                    print("\t!! WARNING: Could not select desired quantity. {} != {}".format(
+                        quantity, selected))
+                self.__journal(original_part_no, in_bag, 'found', selected)
+                continue
+
             # part_no may be overrided if new ID found
             part_no, partno_result = self.__process_partno(original_part_no)
 
-            if partno_result == self.partno_status['found']:
+            if partno_result == self.partno_status['out_of_stock']:
                 print("Found!")
                 added_part[part_no] = original_part_no
+                self.part_stats_counter['out_of_stock'] += 1
+                print("\t!! NOTE: item out of stock.")
+                self.__journal(original_part_no, part_no, 'out_of_stock')
 
-                add_button = self.browser.find_element_by_css_selector('.element-details + button')
+            elif partno_result == self.partno_status['found']:
+                print("Found!")
+                added_part[part_no] = original_part_no
 
-                if add_button.is_enabled():
-                    add_button.click()
-                    sleep(.2)  # seconds
-                    self.part_stats_counter['found'] += 1
+                if self.catalog and self.batch_size > 1:
+                    pending.append((original_part_no, part_no, quantity))
+                    if len(pending) >= self.batch_size:
+                        self.__add_batch(lego_set, pending)
+                        pending = []
                 else:
-                    self.part_stats_counter['out_of_stock'] += 1
-                    print("\t!! NOTE: item out of stock.")
-                    continue
-
-                # set the value for item's quantity drop-down menu
-                amount_select = self.browser.find_elements_by_css_selector('.bag-item select')[-1]
-                Select(amount_select).select_by_visible_text(quantity)
-
-                # ensure the value is correct
-                selected = Select(amount_select).first_selected_option
-
-                if quantity != selected.text:
-                    print("\t!! WARNING: Could not select desired quantity. {} != {}".format(
-                        quantity, selected.text))
+                    self.__add_to_bag(lego_set, original_part_no, part_no, quantity)
 
             elif partno_result == self.partno_status['electric']:
                 print("Not Found, but electric part:")
@@ -636,7 +2355,15 @@ class ReplacementPart(LegoShopBase):
 
                 self.electric_part_list.append(part_no)
                 self.part_stats_counter['electric_part'] += 1
+                self.__journal(original_part_no, part_no, 'electric_part')
             else:
                 print("\t!! OOOPS! No LEGO part with that number found in set #{set}. :-(".format(
                     set=lego_set))
                 self.part_stats_counter['not_in_set'] += 1
+                self.__journal(original_part_no, part_no, 'not_in_set')
+
+        if pending:
+            self.__add_batch(lego_set, pending)
+
+        if bag and self.reconcile:
+            self.__remove_from_bag(bag, set(added_part))
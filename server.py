@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+#    LEGO Mindstorms Editions Pieces Comparison
+#    Copyright (C) 2015-2018  Peter Bittner <django@bittner.it>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Run commands of lego-mindstorms-pieces.py in a long-running process, which
+keeps the data files and browsers it loaded, and talk to it over a local
+Unix socket.
+
+A request is one JSON line, ``{"command": ..., "arguments": {...}}``.  The
+answer is a JSON line ``{"out": text}`` for each piece of output of the
+command, and a last line ``{"exit": status}`` with 0 or an error message.
+"""
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+from contextlib import redirect_stdout
+
+
+class SocketWriter:
+    """
+    File-like object sending everything written to it as output messages
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        if text:
+            send(self.wfile, {'out': text})
+        return len(text)
+
+    def flush(self):
+        self.wfile.flush()
+
+
+def send(wfile, message):
+    wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Run the command of a request, sending its output back as it goes
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            function = self.server.commands[request['command']]
+        except (ValueError, KeyError, TypeError):
+            send(self.wfile, {'exit': "!!! Bad request"})
+            return
+
+        status = 0
+        try:
+            with redirect_stdout(SocketWriter(self.wfile)):
+                function(**request['arguments'])
+        except SystemExit as error:
+            status = error.code or 0
+        except Exception as error:
+            traceback.print_exc()
+            status = "!!! {name}: {error}".format(name=type(error).__name__, error=error)
+
+        send(self.wfile, {'exit': status})
+
+
+class CommandServer(socketserver.UnixStreamServer):
+    """
+    Serve requests for the given commands (name -> function) one at a time,
+    so that they can share a browser.  The socket is only accessible to the
+    user running the server.
+    """
+
+    def __init__(self, path, commands):
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.commands = commands
+
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def serve(self):
+        """
+        Serve requests until interrupted, then remove the socket
+        """
+        print("Serving {commands} on {path}".format(
+            commands=', '.join(sorted(self.commands)), path=self.server_address),
+            file=sys.stderr)
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            os.remove(self.server_address)
+
+
+def request(path, command, arguments):
+    """
+    Send a command to a server, print its output as it arrives
+
+    return 0 or the error message of the command
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(path)
+        except OSError as error:
+            return "Cannot connect to the server at {path}: {error}".format(
+                path=path, error=error.strerror)
+
+        client.sendall(json.dumps({'command': command, 'arguments': arguments})
+                       .encode('utf-8') + b'\n')
+
+        for line in client.makefile('rb'):
+            message = json.loads(line.decode('utf-8'))
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            else:
+                return message['exit']
+
+    return "!!! The server closed the connection"